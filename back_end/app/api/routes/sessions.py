@@ -1,7 +1,13 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Body
+from fastapi.responses import FileResponse, Response
 from pathlib import Path
 import json
-from typing import List, Union
+import threading
+from typing import Callable, List, Union
+from app.utils.storage import read_json, write_json
+from app.services.note_export import (
+    FORMATS, RendererUnavailable, export_session, export_zip, export_filename, delete_session_exports,
+)
 
 router = APIRouter(prefix="/sessions", tags=["sessions"])
 
@@ -10,9 +16,34 @@ DATA_DIR = Path(__file__).resolve().parents[3] / "notes"  # adjust parents count
 DATA_DIR.mkdir(parents=True, exist_ok=True)
 
 
+# One lock per session so concurrent writers (pipeline, drafts, frontend saves) don't interleave
+_SESSION_LOCKS = {}
+_SESSION_LOCKS_GUARD = threading.Lock()
+
+
 def session_file_path(session_id: str) -> Path:
     return DATA_DIR / f"{session_id}.json"
 
+
+def session_lock(session_id: str) -> threading.Lock:
+    with _SESSION_LOCKS_GUARD:
+        return _SESSION_LOCKS.setdefault(session_id, threading.Lock())
+
+
+def update_session(session_id: str, mutate: Callable[[dict], dict]) -> dict:
+    """
+    Transactional read-modify-write of a session file: the session is locked, re-read,
+    mutated and atomically replaced. Raises KeyError if the session does not exist.
+    """
+    fpath = session_file_path(session_id)
+    with session_lock(session_id):
+        session = read_json(fpath, default=None)
+        if session is None:
+            raise KeyError(f"Session {session_id} not found.")
+        session = mutate(session)
+        write_json(fpath, session)
+    return session
+
 @router.get("/", response_model=List[dict])
 def list_sessions():
     sessions = []
@@ -33,8 +64,8 @@ def save_sessions(sessions: Union[List[dict], dict]):
         session_id = session.get("id")
         if not session_id:
             raise HTTPException(status_code=400, detail="Missing session id")
-        fpath = session_file_path(session_id)
-        fpath.write_text(json.dumps(session, ensure_ascii=False, indent=2), encoding="utf-8")
+        with session_lock(session_id):
+            write_json(session_file_path(session_id), session)
 
     return {"ok": True}
 
@@ -43,5 +74,46 @@ def delete_session(session_id: str):
     fpath = session_file_path(session_id)
     if fpath.exists():
         fpath.unlink()
+        delete_session_exports(session_id)
         return {"ok": True}
     raise HTTPException(status_code=404, detail="Session not found")
+
+
+def _load_session(session_id: str) -> dict:
+    session = read_json(session_file_path(session_id), default=None)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    return session
+
+
+def _check_format(format: str):
+    if format not in FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported format '{format}'. Options: {', '.join(FORMATS)}")
+
+
+@router.get("/{session_id}/export")
+def export_session_note(session_id: str, format: str = "pdf"):
+    """Render the session note to PDF or DOCX (cached by content hash)."""
+    _check_format(format)
+    session = _load_session(session_id)
+    try:
+        path = export_session(session, format)
+    except RendererUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    return FileResponse(path, media_type=FORMATS[format], filename=export_filename(session, format))
+
+
+@router.post("/export")
+def export_session_notes(ids: List[str] = Body(..., embed=True), format: str = Body("pdf", embed=True)):
+    """Bulk export: renders the sessions in parallel and returns a zip."""
+    _check_format(format)
+    sessions = [_load_session(session_id) for session_id in ids]
+    try:
+        data = export_zip(sessions, format)
+    except RendererUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    return Response(
+        content=data,
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="notes-{format}.zip"'},
+    )
@@ -1,7 +1,17 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, Form
-from app.services.model_manager import WhisperModelManager
-from app.services.llm_ollama_services import OllamaProcessor
-from app.services.file_utils import convert_to_mono_16khz
+from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Request
+from app.services.stt_engines import get_engine, select_engine, supports_timestamps, ENGINES
+from app.services.llm_ollama_services import OllamaProcessor, get_generation_stats
+from app.services.llm_router import all_pool_stats, validate_target
+from app.services.draft_notes import start_draft, get_draft, pop_draft, register_draft
+from app.utils.audio_archive import AudioArchive
+from app.services.note_pipeline import JOB_STORE, JobAlreadyRunning, submit_note_job, run_note_job, resume_incomplete_jobs
+from app.services.scheduler import SCHEDULER, SchedulerSaturated, PRIORITIES
+from app.api.routes.sessions import update_session, session_file_path
+from app.utils.storage import read_json
+from app.services.file_utils import convert_to_mono_16khz, convert_webm_to_wav
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse
+import asyncio
 import tempfile, os
 from pydantic import BaseModel, Field
 from fastapi.middleware.cors import CORSMiddleware
@@ -10,6 +20,10 @@ import os, json, tempfile, subprocess, textwrap, shutil
 from app.api.routes import sessions
 from pathlib import Path
 
+UPLOAD_DIR = Path("uploads")
+UPLOAD_DIR.mkdir(exist_ok=True)
+AUDIO_ARCHIVE = AudioArchive(UPLOAD_DIR)
+
 app = FastAPI(title="MedScribeAI API")
 app.include_router(sessions.router)
 app.add_middleware(
@@ -18,12 +32,13 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Job-Id", "Retry-After"],
 )
 
 class Options(BaseModel):
-    provider: Optional[str] = None
+    provider: Optional[str] = None  # "ollama" (default) or "openai" (any OpenAI-compatible server)
     attendance_location: Optional[str] = None
-    ollama_url: Optional[str] = None
+    ollama_url: Optional[str] = None  # one URL or a comma-separated list to load-balance across
     llm_model: Optional[str] = None
     stt_model: Optional[str] = None
     temperature: float = 0.0
@@ -41,31 +56,71 @@ class NoteProcessingRequest(BaseModel):
     template_file: Optional[str]
     options: Options
 
+@app.exception_handler(SchedulerSaturated)
+async def scheduler_saturated(request: Request, exc: SchedulerSaturated):
+    retry_after = int(round(exc.retry_after))
+    return JSONResponse(
+        status_code=429,
+        content={"detail": str(exc), "stage": exc.stage, "priority": exc.priority, "retry_after": retry_after},
+        headers={"Retry-After": str(retry_after)},
+    )
+
+def _schedule_context(request: Request, default_priority: str = "interactive") -> dict:
+    """
+    Tenant, priority and deadline for the scheduler, from request headers:
+    X-Clinic-Id / X-User-Id (fair-share tenant, falls back to the client address),
+    X-Priority (live | interactive | batch) and X-Deadline-S (seconds the caller is willing to wait).
+    """
+    headers = request.headers
+    tenant = headers.get("X-Clinic-Id") or headers.get("X-User-Id") or (request.client.host if request.client else "default")
+    priority = headers.get("X-Priority", default_priority).lower()
+    if priority not in PRIORITIES:
+        raise HTTPException(status_code=400, detail=f"Unknown priority '{priority}'. Options: {', '.join(PRIORITIES)}")
+    deadline_s = headers.get("X-Deadline-S")
+    try:
+        deadline_s = float(deadline_s) if deadline_s is not None else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="X-Deadline-S must be a number of seconds.")
+    return {"tenant": tenant, "priority": priority, "deadline_s": deadline_s}
+
+def _check_llm_target(provider: Optional[str], ollama_url: Optional[str]):
+    """Client-chosen provider/URLs must be known and configured on the server (no forwarding elsewhere)."""
+    try:
+        validate_target(provider, ollama_url)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def _check_stt_engine(stt_engine: str):
+    if stt_engine != "auto" and stt_engine not in ENGINES:
+        raise HTTPException(
+            status_code=400, detail=f"Unknown STT engine '{stt_engine}'. Options: auto, {', '.join(ENGINES)}"
+        )
+
 def _write_note_tmp(tmpdir: str, note: str) -> str:
     note_path = os.path.join(tmpdir, "note.txt")
     with open(note_path, "w", encoding="utf-8") as f:
         f.write(note)
     return note_path
 
-def convert_webm_to_wav(webm_path: str) -> str:
-    wav_path = webm_path.replace(".webm", ".wav")
-    # using ffmpeg to convert webm -> wav
-    subprocess.run([
-        "ffmpeg", "-i", webm_path, "-ar", "16000", "-ac", "1", wav_path
-    ], check=True)
-    return wav_path
-
 @app.post("/transcribe")
 async def transcribe_audio(
+    request: Request,
     file: UploadFile = File(...),
     speech_model: str = "small.en",
     llm_model: str = "qwen3:4b-instruct",
-    save_copy: bool = False
+    save_copy: bool = False,
+    stt_engine: str = "faster-whisper",
 ):
     # Check file extension
     ext = Path(file.filename).suffix.lower()
     if ext not in [".wav", ".webm"]:
         return {"error": "Only .wav or .webm files are supported."}
+    _check_stt_engine(stt_engine)
+
+    # Reject early (429) when the STT queue is full, before spending time on decoding
+    ctx = _schedule_context(request)
+    SCHEDULER.check_admission("stt", ctx["priority"])
 
     # Save temporary file
     with tempfile.NamedTemporaryFile(delete=False, suffix=ext) as tmp_file:
@@ -81,19 +136,22 @@ async def transcribe_audio(
     # Convert to mono 16kHz if needed
     tmp_path = convert_to_mono_16khz(tmp_path)
 
-    # Optionally save a copy
-    saved_path = None
+    # Optionally archive a compressed copy (keyed by content hash)
+    audio_key = None
     if save_copy:
-        save_dir = Path("saved_audio")
-        save_dir.mkdir(exist_ok=True)
-        saved_path = save_dir / Path(file.filename).with_suffix(".wav")
-        shutil.copy(tmp_path, saved_path)
+        audio_key = await run_in_threadpool(AUDIO_ARCHIVE.store, tmp_path, name=file.filename)
 
     # Transcribe
-    # Load Whisper model once
-    whisper_model = WhisperModelManager("CACHE_DIR")
-    loaded_model = whisper_model.load_model(speech_model)
-    text = whisper_model.transcribe(tmp_path)
+    # Engines are loaded once and reused across requests ("auto" picks one from the host's measured RTF)
+    # Loading (or, for "auto", measuring) engines blocks, so keep it off the event loop
+    try:
+        engine = await run_in_threadpool(get_engine, stt_engine, speech_model)
+    except FileNotFoundError as e:
+        os.unlink(tmp_path)
+        raise HTTPException(status_code=503, detail=str(e))
+    # Wait for an STT slot without holding a worker thread
+    async with SCHEDULER.slot_async("stt", **ctx):
+        text = await run_in_threadpool(engine.transcribe, tmp_path)
 
     # Cleanup temp file
     os.unlink(tmp_path)
@@ -109,109 +167,231 @@ async def transcribe_audio(
         f.write(text)
 
     response = {"transcription": text}
+    if audio_key:
+        response["audio_key"] = audio_key
     return response
 
 @app.post("/transcribe_process")
 async def process_transcription(
+    request: Request,
     file: UploadFile = File(...),
     session_id: str = Form(...),  # frontend passes active session ID
     speech_model: str = "small.en",
     llm_model: str = Form(...),
+    provider: Optional[str] = Form(None),
+    ollama_url: Optional[str] = Form(None),
+    diarize: bool = Form(False),
+    stt_engine: str = Form("faster-whisper"),
 ):
     """
-    Use session_id to load session JSON, extract template, save with transcription and default prompt
-    to a temp folder, then run LLM pipeline.
+    Use session_id to load session JSON, extract template, then run the STT + LLM pipeline.
+    Every stage is checkpointed under a job id (returned in the X-Job-Id header): retrying the same
+    request, or restarting the server, resumes from the last completed stage.
+    Returns 429 with Retry-After when the STT/LLM queues for this priority class are full.
     """
-    import tempfile, shutil, json, os
-    tmpdir = tempfile.mkdtemp()
     print("session_id:", session_id)
+    ext = Path(file.filename).suffix.lower()
+    if ext not in [".wav", ".webm"]:
+        return {"error": "Only .wav or .webm files are supported."}
+
+    _check_llm_target(provider, ollama_url)
+    _check_stt_engine(stt_engine)
+    if diarize and stt_engine in ENGINES and not supports_timestamps(stt_engine):
+        raise HTTPException(status_code=400, detail=f"diarize=true needs segment timestamps; '{stt_engine}' has none.")
+
+    ctx = _schedule_context(request)
+    SCHEDULER.check_admission("stt", ctx["priority"])
+
+    options = Options(provider=provider, ollama_url=ollama_url, llm_model=llm_model, stt_model=speech_model)
+    params = {
+        "speech_model": options.stt_model,
+        "stt_engine": stt_engine,
+        "diarize": diarize,
+        "llm_model": options.llm_model,
+        "provider": options.provider,
+        "ollama_url": options.ollama_url,
+    }
+    audio_bytes = await file.read()
     try:
-        # --- Save uploaded audio ---
-        ext = Path(file.filename).suffix.lower()
-        if ext not in [".wav", ".webm"]:
-            return {"error": "Only .wav or .webm files are supported."}
-
-        with tempfile.NamedTemporaryFile(delete=False, suffix=ext) as tmp_file:
-            tmp_file.write(await file.read())
-            tmp_path = tmp_file.name
-
-        if ext == ".webm":
-            tmp_path_wav = convert_webm_to_wav(tmp_path)
-            os.unlink(tmp_path)
-            tmp_path = tmp_path_wav
-
-        tmp_path = convert_to_mono_16khz(tmp_path)
-
-        # --- Transcribe audio ---
-        whisper_model = WhisperModelManager("CACHE_DIR")
-        model = whisper_model.load_model(speech_model)
-        transcription_text = whisper_model.transcribe(tmp_path)
-        os.unlink(tmp_path)
-        print(f"[Main] Transcription: completed, {len(transcription_text)} chars")
-        # --- Save transcription to temp ---
-        transcription_path = os.path.join(tmpdir, "transcription.txt")
-        with open(transcription_path, "w", encoding="utf-8") as f:
-            f.write(transcription_text)
-
-        # --- Load session JSON and extract template ---
-        notes_dir = Path(__file__).resolve().parents[1] / "notes"
-        print("notes_dir:", notes_dir)
-        session_file = notes_dir / f"{session_id}.json"
-        print("session_file_exists:", session_file.exists())
-        print("session_id:", session_id)
-        if not session_file.exists():
-            raise HTTPException(status_code=404, detail=f"Session {session_id} not found.")
-
-        with open(session_file, "r", encoding="utf-8") as f:
-            session_data = json.load(f)
-
-        template_content = session_data.get("content", {})
-
-        template_path = os.path.join(tmpdir, "template.json")
-        with open(template_path, "w", encoding="utf-8") as f:
-            json.dump(template_content, f, ensure_ascii=False, indent=2)
-        print(f"[Main] Template saved to: {template_path}")
-        
-        # --- Save default prompt file ---
-        prompt_temp_path = Path(__file__).parent / "note_structuring_prompt.txt"
-
-        print(f"[Main] Prompt file: {prompt_temp_path}")
-        # --- Run LLM pipeline ---
-        ollama_processor = OllamaProcessor(
-        model=llm_model
-        )
-        
-        print(f"[LLM Pipeline] Generating structured notes using Ollama...")
-        structured_notes = ollama_processor.process(
-            transcription_text,
-            prompt_path=prompt_temp_path,
-            template_path=template_path
-        )
-        
-        print(f"[Main] LLM processing completed.", structured_notes)
-        
-        # --- Update session JSON with new content ---
-        print("Updating session JSON with new structured notes...")
-        session_file = notes_dir / f"{session_id}.json"
-        if session_file.exists():
-            print("Trying to open session file:", session_file)
-            with open(session_file, "r", encoding="utf-8") as f:
-                session_data = json.load(f)
-
-            # Replace the content object
-            session_data["content"] = structured_notes
-            print("Replaced content in session_data.")
-            # Save back to the same file
-            with open(session_file, "w", encoding="utf-8") as f:
-                json.dump(session_data, f, ensure_ascii=False, indent=2)
-        print(f"[Main] Session {session_id} updated.")
-        return ("ok")
+        # Hashing and persisting the upload is file I/O: keep it off the event loop
+        job_id = await asyncio.to_thread(submit_note_job, session_id, file.filename, audio_bytes, params)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+    try:
+        structured_notes = await run_note_job(job_id, JOB_STORE, **ctx)
+    except JobAlreadyRunning as e:
+        # Duplicate submission while the first is still in progress: poll /jobs/{id} instead
+        raise HTTPException(status_code=409, detail=str(e), headers={"X-Job-Id": job_id})
+    except SchedulerSaturated:
+        # 429 + Retry-After; the job keeps its checkpoints, so the retry resumes it
+        raise
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise HTTPException(status_code=500, detail=f"{e} (job {job_id})", headers={"X-Job-Id": job_id})
 
-    finally:
-        shutil.rmtree(tmpdir, ignore_errors=True)
+    print(f"[Main] LLM processing completed.", structured_notes)
+    return JSONResponse("ok", headers={"X-Job-Id": job_id})
 
 
-UPLOAD_DIR = Path("uploads")
-UPLOAD_DIR.mkdir(exist_ok=True)
\ No newline at end of file
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    job = JOB_STORE.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found.")
+    return job
+
+
+@app.on_event("startup")
+async def resume_jobs():
+    # Pick up jobs interrupted by a crash without blocking startup
+    app.state.resume_task = asyncio.create_task(resume_incomplete_jobs())
+
+
+@app.on_event("shutdown")
+def flush_audio_index():
+    # Access stats from range reads are persisted lazily
+    AUDIO_ARCHIVE.flush()
+
+
+# ---------------- Incremental draft notes (live recording) ----------------
+
+@app.post("/drafts/{session_id}/start")
+def start_draft_note(
+    request: Request,
+    session_id: str,
+    llm_model: str = Form(...),
+    provider: Optional[str] = Form(None),
+    ollama_url: Optional[str] = Form(None),
+):
+    """Start a background draft note for a session that is being recorded."""
+    _check_llm_target(provider, ollama_url)
+    session_data = read_json(session_file_path(session_id), default=None)
+    if session_data is None:
+        raise HTTPException(status_code=404, detail=f"Session {session_id} not found.")
+
+    ctx = _schedule_context(request, default_priority="live")
+    SCHEDULER.check_admission("llm", "live")
+    processor = OllamaProcessor(model=llm_model, url=ollama_url, provider=provider)
+    try:
+        draft = start_draft(session_id, session_data.get("content", {}), processor, tenant=ctx["tenant"])
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return draft.status()
+
+
+@app.post("/drafts/{session_id}/segments")
+def add_draft_segment(session_id: str, text: str = Form(...)):
+    """Feed a committed transcript segment; the draft is refreshed in the background."""
+    draft = get_draft(session_id)
+    if draft is None:
+        raise HTTPException(status_code=404, detail=f"No draft in progress for session {session_id}.")
+    try:
+        draft.add_segment(text)
+    except RuntimeError as e:
+        # Finalize is in progress for this draft
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"segments": len(draft.segments), "consumed": draft.consumed}
+
+
+@app.get("/drafts/{session_id}")
+def get_draft_note(session_id: str):
+    draft = get_draft(session_id)
+    if draft is None:
+        raise HTTPException(status_code=404, detail=f"No draft in progress for session {session_id}.")
+    return draft.status()
+
+
+@app.post("/drafts/{session_id}/finalize")
+def finalize_draft_note(session_id: str):
+    """
+    Recording stopped: run the short finalize pass and save the note into the session.
+    If the final update fails the session is left unchanged and the draft kept, so finalize can be retried.
+    """
+    draft = pop_draft(session_id)
+    if draft is None:
+        raise HTTPException(status_code=404, detail=f"No draft in progress for session {session_id}.")
+    try:
+        structured_notes = draft.finalize()
+    except RuntimeError as e:
+        register_draft(draft)
+        raise HTTPException(status_code=502, detail=str(e))
+
+    def replace_content(session: dict) -> dict:
+        session["content"] = structured_notes
+        return session
+
+    try:
+        update_session(session_id, replace_content)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    print(f"[Main] Session {session_id} updated from live draft.")
+    return {"content": structured_notes, "transcription": draft.transcript}
+
+
+@app.get("/llm/stats")
+def llm_stats():
+    """Structured-output repair rate and token cost since startup."""
+    return get_generation_stats()
+
+
+@app.get("/llm/backends")
+def llm_backends():
+    """Health, load and resident models for each LLM backend pool."""
+    return all_pool_stats()
+
+
+@app.get("/scheduler/metrics")
+def scheduler_metrics():
+    """Queue depth, wait times, admissions/rejections and per-tenant share for the STT and LLM stages."""
+    return SCHEDULER.metrics()
+
+
+@app.get("/stt/selection")
+def stt_selection(refresh: bool = False):
+    """Engine/model picked for this host from measured real-time factor (cached)."""
+    try:
+        return select_engine(refresh=refresh)
+    except (FileNotFoundError, ValueError) as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+
+# ---------------- Audio archive ----------------
+@app.get("/audio")
+def list_audio():
+    return AUDIO_ARCHIVE.list()
+
+
+@app.post("/audio/{audio_key}/transcribe")
+async def transcribe_archived_audio(
+    request: Request,
+    audio_key: str,
+    start: float = 0.0,
+    end: Optional[float] = None,
+    speech_model: str = "small.en",
+    stt_engine: str = "faster-whisper",
+):
+    """Re-transcribe a time range of an archived recording without decoding the whole file."""
+    _check_stt_engine(stt_engine)
+    ctx = _schedule_context(request)
+    SCHEDULER.check_admission("stt", ctx["priority"])
+    try:
+        audio = await run_in_threadpool(AUDIO_ARCHIVE.read_range, audio_key, start, end)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+    try:
+        engine = await run_in_threadpool(get_engine, stt_engine, speech_model)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    async with SCHEDULER.slot_async("stt", **ctx):
+        text = await run_in_threadpool(engine.transcribe, audio)
+    return {"audio_key": audio_key, "start": start, "end": end, "transcription": text}
+
+
+@app.delete("/audio/{audio_key}")
+def delete_audio(audio_key: str):
+    try:
+        AUDIO_ARCHIVE.delete(audio_key)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return {"ok": True}
\ No newline at end of file
@@ -2,7 +2,7 @@
 import argparse
 from pathlib import Path
 from app.services.file_utils import convert_to_mono_16khz
-from app.services.model_manager import WhisperModelManager
+from app.services.stt_engines import get_engine, ENGINES
 
 
 def run_stt_pipeline(
@@ -12,33 +12,29 @@ def run_stt_pipeline(
     use_faster: bool = True,
     batched: bool = False,
     batched_size: int = 16,
+    engine: str = None,
 ):
     """
     Speech-to-Text (STT) pipeline:
     - Converts input audio to mono 16kHz WAV
-    - Transcribes using Whisper (faster-whisper or openai-whisper)
+    - Transcribes using the selected STT engine (faster-whisper, openai-whisper, nemo, or "auto")
     - Saves transcription to output file
     - Returns transcription text
     """
     # 1️⃣ Preprocess the audio (ensure correct format)
     audio_path = convert_to_mono_16khz(audio_path)
 
-    # 2️⃣ Initialize Whisper model
-    stt_manager = WhisperModelManager(model_dir="CACHE_DIR")
-    stt_model = stt_manager.load_model(
-        model_name=model_name,
-        batched_model=batched,
-        use_faster=use_faster
-    )
+    # 2️⃣ Initialize STT engine
+    engine = engine or ("faster-whisper" if use_faster else "openai-whisper")
+    stt_engine = get_engine(engine, model_name)
 
     # 3️⃣ Transcribe
-    engine_name = "faster-whisper" if use_faster else "openai-whisper"
-    print(f"[STT Pipeline] Transcribing using {engine_name} (batched={batched}, model={model_name})")
+    print(f"[STT Pipeline] Transcribing using {stt_engine.name} (batched={batched}, model={stt_engine.model_name})")
 
     if batched:
-        transcription = stt_manager.batched_transcribe(audio_path, batched_size=batched_size)
+        transcription = stt_engine.batched_transcribe(audio_path, batch_size=batched_size)
     else:
-        transcription = stt_manager.transcribe(audio_path)
+        transcription = stt_engine.transcribe(audio_path)
 
     # 4️⃣ Save output
     output_path = Path(output_file)
@@ -72,6 +68,12 @@ if __name__ == "__main__":
         action="store_true",
         help="Use faster-whisper instead of vanilla whisper"
     )
+    parser.add_argument(
+        "--engine",
+        default=None,
+        choices=["auto", *ENGINES],
+        help="STT engine (default: faster-whisper, or openai-whisper without --use-faster)"
+    )
     parser.add_argument(
         "--batched",
         action="store_true",
@@ -94,4 +96,5 @@ if __name__ == "__main__":
         use_faster=args.use_faster,
         batched=args.batched,
         batched_size=args.batch_size,
+        engine=args.engine,
     )
@@ -0,0 +1,189 @@
+# services/draft_notes.py
+import os
+import copy
+import json
+import threading
+from pathlib import Path
+from app.services.llm_ollama_services import OllamaProcessor
+from app.services.scheduler import SCHEDULER
+
+DRAFT_DEBOUNCE_S = float(os.environ.get("DRAFT_DEBOUNCE_S", "20"))  # seconds of new transcript batched per update
+DRAFT_PROMPT_PATH = Path(__file__).resolve().parents[1] / "draft_update_prompt.txt"
+
+
+class DraftNoteSession:
+    def __init__(
+        self,
+        session_id: str,
+        template: dict,
+        processor: OllamaProcessor,
+        debounce: float = DRAFT_DEBOUNCE_S,
+        prompt_path: str | Path = DRAFT_PROMPT_PATH,
+        tenant: str = "default",
+    ):
+        """
+        Keep a draft note up to date while a consultation is being recorded.
+        Committed transcript segments are batched for `debounce` seconds, then the LLM
+        receives only the new transcript delta plus the previous draft.
+        Updates run in the scheduler's "live" class, ahead of interactive and batch jobs.
+        """
+        self.session_id = session_id
+        self.template = template
+        self.processor = processor
+        self.debounce = debounce
+        self.tenant = tenant
+        self.prompt_text = Path(prompt_path).read_text(encoding="utf-8")
+
+        self.segments = []
+        self.consumed = 0          # segments already folded into the draft
+        self.draft = copy.deepcopy(template)
+        self.updates = 0
+
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._timer = None
+        self._running = False
+        self._finalized = False
+
+    def add_segment(self, text: str):
+        """Add a committed transcript segment and schedule a background draft update."""
+        text = (text or "").strip()
+        if not text:
+            return
+        with self._lock:
+            if self._finalized:
+                raise RuntimeError(f"Draft for session {self.session_id} is already finalized.")
+            self.segments.append(text)
+            self._schedule()
+
+    def _schedule(self):
+        # Caller holds the lock
+        if self._timer is None and not self._running and not self._finalized:
+            self._timer = threading.Timer(self.debounce, self._background_update)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _background_update(self):
+        with self._lock:
+            self._timer = None
+        self._update()
+        with self._lock:
+            if self.consumed < len(self.segments):
+                self._schedule()
+
+    def _update(self) -> bool:
+        with self._lock:
+            if self._running or self.consumed >= len(self.segments):
+                return False
+            self._running = True
+            end = len(self.segments)
+            delta = " ".join(self.segments[self.consumed:end])
+            previous = self.draft
+            full_transcript = " ".join(self.segments[:end])
+
+        try:
+            prompt = self.prompt_text.replace("<<TEMPLATE>>", json.dumps(self.template, ensure_ascii=False, indent=2))
+            prompt = prompt.replace("<<DRAFT>>", json.dumps(previous, ensure_ascii=False, indent=2))
+            prompt = prompt.replace("<<TRANSCRIPTION>>", delta)
+            # Repairs (rare) get the full transcript so far, since a single field may span earlier deltas
+            # Runs on the debounce timer's own thread; an admitted draft is never rejected mid-recording
+            with SCHEDULER.slot("llm", self.tenant, "live", enforce=False):
+                result = self.processor.generate_structured(prompt, full_transcript, self.template)
+        except Exception as e:
+            print(f"[DraftNoteSession] Draft update failed: {e}")
+            result = None
+
+        with self._lock:
+            if isinstance(result, dict) and result:
+                self.draft = result
+                self.consumed = end
+                self.updates += 1
+                print(f"[DraftNoteSession] {self.session_id}: draft updated ({end} segments)")
+            self._running = False
+            self._idle.notify_all()
+        return isinstance(result, dict) and bool(result)
+
+    def finalize(self, attempts: int = 2) -> dict:
+        """
+        Stop background updates and fold in whatever transcript is left.
+        Returns only once every segment is in the draft (an update the debounce timer started in the
+        meantime is waited for); raises RuntimeError if the remaining transcript could not be folded
+        in after `attempts` tries, so an incomplete note is never returned as final. A failed finalize
+        reopens the draft, so segments can still be added and finalize retried.
+        """
+        with self._lock:
+            self._finalized = True
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+        failures = 0
+        while True:
+            with self._lock:
+                while self._running:
+                    self._idle.wait()
+                if self.consumed >= len(self.segments):
+                    return self.draft
+                before = self.consumed
+            if failures >= attempts:
+                with self._lock:
+                    # Reopen the draft: segments can still be added and finalize retried
+                    self._finalized = False
+                raise RuntimeError(
+                    f"Draft for session {self.session_id} is missing {len(self.segments) - before} segment(s); "
+                    "final update failed."
+                )
+            self._update()
+            with self._lock:
+                while self._running:
+                    self._idle.wait()
+                if self.consumed == before:
+                    failures += 1
+
+    @property
+    def transcript(self) -> str:
+        with self._lock:
+            return " ".join(self.segments)
+
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                "session_id": self.session_id,
+                "draft": self.draft,
+                "segments": len(self.segments),
+                "consumed": self.consumed,
+                "updates": self.updates,
+                "updating": self._running,
+                "finalized": self._finalized,
+            }
+
+
+# Active drafts keyed by session id
+_DRAFTS = {}
+_DRAFTS_LOCK = threading.Lock()
+
+
+def start_draft(session_id: str, template: dict, processor: OllamaProcessor, **kwargs) -> DraftNoteSession:
+    """Raises RuntimeError if the session already has a draft in progress (its timer would keep running)."""
+    draft = DraftNoteSession(session_id, template, processor, **kwargs)
+    with _DRAFTS_LOCK:
+        if session_id in _DRAFTS:
+            raise RuntimeError(f"A draft is already in progress for session {session_id}.")
+        _DRAFTS[session_id] = draft
+    return draft
+
+
+def register_draft(draft: DraftNoteSession) -> DraftNoteSession:
+    with _DRAFTS_LOCK:
+        _DRAFTS[draft.session_id] = draft
+    return draft
+
+
+def get_draft(session_id: str) -> DraftNoteSession:
+    with _DRAFTS_LOCK:
+        return _DRAFTS.get(session_id)
+
+
+def pop_draft(session_id: str) -> DraftNoteSession:
+    with _DRAFTS_LOCK:
+        return _DRAFTS.pop(session_id, None)
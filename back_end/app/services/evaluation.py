@@ -0,0 +1,312 @@
+# services/evaluation.py
+import re
+import json
+import time
+import argparse
+from pathlib import Path
+import numpy as np
+import sacrebleu
+from app.services.stt_engines import create_engine, _duration
+
+_PUNCT = re.compile(r"[^\w\s']")
+
+
+# ---------------- Reference set ----------------
+def load_reference_set(path: str | Path) -> list:
+    """
+    Load evaluation items: either a JSONL manifest with {"audio", "reference" | "reference_path",
+    optional "notes" (gold note dict or path)} per line, or a directory of <name>.wav + <name>.txt
+    (+ optional <name>.notes.json) files.
+    """
+    path = Path(path)
+    items = []
+    if path.is_dir():
+        for audio in sorted(path.glob("*.wav")):
+            ref = audio.with_suffix(".txt")
+            if not ref.exists():
+                continue
+            item = {"id": audio.stem, "audio": str(audio), "reference": ref.read_text(encoding="utf-8")}
+            notes = audio.with_name(f"{audio.stem}.notes.json")
+            if notes.exists():
+                item["notes"] = json.loads(notes.read_text(encoding="utf-8"))
+            items.append(item)
+        return items
+
+    base = path.parent
+    for i, line in enumerate(path.read_text(encoding="utf-8").splitlines()):
+        if not line.strip():
+            continue
+        row = json.loads(line)
+        item = {"id": row.get("id", str(i)), "audio": str(base / row["audio"])}
+        if "reference" in row:
+            item["reference"] = row["reference"]
+        else:
+            item["reference"] = (base / row["reference_path"]).read_text(encoding="utf-8")
+        notes = row.get("notes")
+        if isinstance(notes, str):
+            notes = json.loads((base / notes).read_text(encoding="utf-8"))
+        if notes is not None:
+            item["notes"] = notes
+        items.append(item)
+    return items
+
+
+# ---------------- Text metrics ----------------
+def normalize_text(text: str) -> str:
+    return " ".join(_PUNCT.sub(" ", (text or "").lower()).split())
+
+
+def batched_edit_distance(refs: list, hyps: list) -> np.ndarray:
+    """
+    Levenshtein distance for every (ref, hyp) token-sequence pair at once.
+    The DP runs row by row over the reference, vectorized over the whole set and over hypothesis
+    positions (insertions via a running-minimum scan), so the Python loop is only max(len(ref)) long.
+    """
+    n = len(refs)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+    vocab = {}
+    encode = lambda seq: [vocab.setdefault(tok, len(vocab) + 1) for tok in seq]
+    ref_len = np.array([len(r) for r in refs])
+    hyp_len = np.array([len(h) for h in hyps])
+    max_ref, max_hyp = max(ref_len.max(), 1), max(hyp_len.max(), 1)
+
+    # -1 / -2 padding never matches a real token
+    ref_ids = np.full((n, max_ref), -1, dtype=np.int64)
+    hyp_ids = np.full((n, max_hyp), -2, dtype=np.int64)
+    for b, (r, h) in enumerate(zip(refs, hyps)):
+        ref_ids[b, :len(r)] = encode(r)
+        hyp_ids[b, :len(h)] = encode(h)
+
+    cols = np.arange(max_hyp + 1)
+    prev = np.tile(cols, (n, 1))
+    result = prev[np.arange(n), hyp_len].copy()  # empty reference: distance = len(hyp)
+    for i in range(1, max_ref + 1):
+        sub = prev[:, :-1] + (ref_ids[:, i - 1:i] != hyp_ids)
+        dele = prev[:, 1:] + 1
+        tmp = np.empty_like(prev)
+        tmp[:, 0] = i
+        tmp[:, 1:] = np.minimum(sub, dele)
+        # cur[j] = min_k<=j (tmp[k] + j - k)  (insertions)
+        cur = np.minimum.accumulate(tmp - cols, axis=1) + cols
+        done = ref_len == i
+        result[done] = cur[done, hyp_len[done]]
+        prev = cur
+    return result
+
+
+def error_rates(references: list, hypotheses: list) -> dict:
+    """Corpus and per-item WER/CER (on normalized text) plus corpus BLEU."""
+    refs = [normalize_text(r) for r in references]
+    hyps = [normalize_text(h) for h in hypotheses]
+    ref_words, hyp_words = [r.split() for r in refs], [h.split() for h in hyps]
+    ref_chars, hyp_chars = [list(r) for r in refs], [list(h) for h in hyps]
+
+    word_dist = batched_edit_distance(ref_words, hyp_words)
+    char_dist = batched_edit_distance(ref_chars, hyp_chars)
+    n_words = np.array([max(len(r), 1) for r in ref_words])
+    n_chars = np.array([max(len(r), 1) for r in ref_chars])
+    return {
+        "wer": float(word_dist.sum() / n_words.sum()),
+        "cer": float(char_dist.sum() / n_chars.sum()),
+        "bleu": sacrebleu.corpus_bleu(hyps, [refs]).score,
+        "per_item_wer": (word_dist / n_words).tolist(),
+        "per_item_cer": (char_dist / n_chars).tolist(),
+    }
+
+
+# ---------------- Note field agreement ----------------
+def flatten_note(note, prefix: str = "") -> dict:
+    """Nested note -> {"a.b": leaf}; lists are kept as leaves."""
+    if isinstance(note, dict):
+        flat = {}
+        for key, value in note.items():
+            flat.update(flatten_note(value, f"{prefix}.{key}" if prefix else key))
+        return flat
+    return {prefix: note}
+
+
+def _is_empty(value) -> bool:
+    return value is None or value == "" or value == [] or value == {}
+
+
+def _f1(gold: list, pred: list) -> float:
+    gold, pred = list(gold), list(pred)
+    if not gold and not pred:
+        return 1.0
+    common = 0
+    remaining = list(pred)
+    for tok in gold:
+        if tok in remaining:
+            remaining.remove(tok)
+            common += 1
+    if common == 0:
+        return 0.0
+    precision, recall = common / len(pred), common / len(gold)
+    return 2 * precision * recall / (precision + recall)
+
+
+def field_score(gold, pred) -> float:
+    """1.0/0.0 for empty-vs-empty, item F1 for lists, token F1 for text."""
+    if _is_empty(gold) or _is_empty(pred):
+        return float(_is_empty(gold) and _is_empty(pred))
+    if isinstance(gold, list) or isinstance(pred, list):
+        as_items = lambda v: [normalize_text(json.dumps(x) if isinstance(x, (dict, list)) else str(x)) for x in (v if isinstance(v, list) else [v])]
+        return _f1(as_items(gold), as_items(pred))
+    return _f1(normalize_text(str(gold)).split(), normalize_text(str(pred)).split())
+
+
+def field_agreement(gold_notes: list, pred_notes: list) -> dict:
+    """
+    Field-level agreement over a set of notes:
+    - field_f1: mean score over all gold fields
+    - filled_recall: mean score over fields the gold note fills
+    - hallucination_rate: share of gold-empty fields the prediction filled anyway
+    """
+    scores, filled, hallucinated, empty = [], [], 0, 0
+    per_field = {}
+    for gold, pred in zip(gold_notes, pred_notes):
+        gold_flat = flatten_note(gold)
+        pred_flat = flatten_note(pred if isinstance(pred, dict) else {})
+        for path, gold_value in gold_flat.items():
+            pred_value = pred_flat.get(path)
+            score = field_score(gold_value, pred_value)
+            scores.append(score)
+            per_field.setdefault(path, []).append(score)
+            if _is_empty(gold_value):
+                empty += 1
+                hallucinated += not _is_empty(pred_value)
+            else:
+                filled.append(score)
+    return {
+        "field_f1": float(np.mean(scores)) if scores else None,
+        "filled_recall": float(np.mean(filled)) if filled else None,
+        "hallucination_rate": hallucinated / empty if empty else None,
+        "per_field": {path: float(np.mean(s)) for path, s in sorted(per_field.items())},
+    }
+
+
+def template_from_gold(note):
+    """Blank template with the gold note's structure (what the pipeline would be given)."""
+    if isinstance(note, dict):
+        return {key: template_from_gold(value) for key, value in note.items()}
+    return [] if isinstance(note, list) else None
+
+
+# ---------------- Runs ----------------
+def evaluate_stt(items: list, engine: str, model_name: str = None, batched: bool = False, **engine_kwargs) -> dict:
+    """Run one STT configuration over the set: accuracy next to latency / real-time factor."""
+    stt = create_engine(engine, model_name, **engine_kwargs)
+    start = time.perf_counter()
+    stt.load()
+    load_s = time.perf_counter() - start
+
+    hypotheses, latencies, audio_s = [], [], 0.0
+    for item in items:
+        start = time.perf_counter()
+        text = stt.batched_transcribe(item["audio"]) if batched else stt.transcribe(item["audio"])
+        latencies.append(time.perf_counter() - start)
+        hypotheses.append(text)
+        audio_s += _duration(item["audio"])
+
+    metrics = error_rates([item["reference"] for item in items], hypotheses)
+    return {
+        "config": f"{engine}:{stt.model_name}" + (":batched" if batched else ""),
+        "load_s": load_s,
+        "latency_mean_s": float(np.mean(latencies)) if latencies else 0.0,
+        "latency_p95_s": float(np.percentile(latencies, 95)) if latencies else 0.0,
+        "rtf": sum(latencies) / audio_s if audio_s else 0.0,
+        **metrics,
+        "hypotheses": hypotheses,
+    }
+
+
+def evaluate_notes(items: list, transcripts: list, llm_model: str, prompt_path: str | Path = None, **processor_kwargs) -> dict:
+    """Generate notes from transcripts and score them field by field against the gold notes."""
+    from app.services.llm_ollama_services import OllamaProcessor
+
+    prompt_path = Path(prompt_path or Path(__file__).resolve().parents[1] / "note_structuring_prompt.txt")
+    prompt_text = prompt_path.read_text(encoding="utf-8")
+    processor = OllamaProcessor(model=llm_model, **processor_kwargs)
+
+    gold, preds, latencies, tokens = [], [], [], 0
+    for item, transcript in zip(items, transcripts):
+        if "notes" not in item:
+            continue
+        template = template_from_gold(item["notes"])
+        prompt = prompt_text.replace("<<TRANSCRIPTION>>", transcript)
+        prompt = prompt.replace("<<TEMPLATE>>", json.dumps(template, ensure_ascii=False, indent=2))
+        start = time.perf_counter()
+        pred = processor.generate_structured(prompt, transcript, template)
+        latencies.append(time.perf_counter() - start)
+        tokens += processor.last_report.get("prompt_tokens", 0) + processor.last_report.get("completion_tokens", 0)
+        gold.append(item["notes"])
+        preds.append(pred)
+
+    return {
+        "llm_model": llm_model,
+        "notes": len(gold),
+        "latency_mean_s": float(np.mean(latencies)) if latencies else 0.0,
+        "tokens_per_note": tokens / len(gold) if gold else 0.0,
+        **field_agreement(gold, preds),
+    }
+
+
+def pareto_frontier(rows: list, cost: str = "rtf", error: str = "wer") -> list:
+    """Mark rows not dominated on (cost, error) — both lower is better."""
+    costs = np.array([r[cost] for r in rows])
+    errors = np.array([r[error] for r in rows])
+    for i, row in enumerate(rows):
+        dominated = (costs <= costs[i]) & (errors <= errors[i]) & ((costs < costs[i]) | (errors < errors[i]))
+        row["pareto"] = not dominated.any()
+    return rows
+
+
+def print_report(rows: list):
+    print(f"{'config':40} {'WER':>7} {'CER':>7} {'BLEU':>6} {'RTF':>7} {'lat(s)':>7} {'p95(s)':>7}  pareto")
+    for r in sorted(rows, key=lambda r: r["rtf"]):
+        print(
+            f"{r['config']:40} {r['wer']:7.3f} {r['cer']:7.3f} {r['bleu']:6.1f} {r['rtf']:7.3f} "
+            f"{r['latency_mean_s']:7.2f} {r['latency_p95_s']:7.2f}  {'*' if r.get('pareto') else ''}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate STT configurations (WER/CER/BLEU vs latency) and LLM note fields")
+    parser.add_argument("--refs", required=True, help="JSONL manifest or directory of .wav + .txt (+ .notes.json)")
+    parser.add_argument(
+        "--configs", nargs="+", default=["faster-whisper:tiny.en", "faster-whisper:small.en"],
+        help="STT configurations as engine:model[:batched]"
+    )
+    parser.add_argument("--llm-model", default=None, help="Also score LLM notes against gold notes with this model")
+    parser.add_argument("--output", default=None, help="Save the full results as JSON")
+    args = parser.parse_args()
+
+    items = load_reference_set(args.refs)
+    print(f"[Evaluation] {len(items)} reference items")
+
+    rows = []
+    for config in args.configs:
+        engine, _, rest = config.partition(":")
+        model_name, _, mode = rest.partition(":")
+        print(f"[Evaluation] Running {config}...")
+        rows.append(evaluate_stt(items, engine, model_name or None, batched=(mode == "batched")))
+    pareto_frontier(rows)
+    print_report(rows)
+
+    results = {"stt": rows}
+    if args.llm_model:
+        # Notes are generated from the best (lowest WER) transcript set on the frontier
+        best = min((r for r in rows if r["pareto"]), key=lambda r: r["wer"])
+        results["notes"] = evaluate_notes(items, best["hypotheses"], args.llm_model)
+        results["notes"]["stt_config"] = best["config"]
+        n = results["notes"]
+        print(
+            f"[Evaluation] Notes ({args.llm_model} on {best['config']}): field F1 {n['field_f1']}, "
+            f"filled recall {n['filled_recall']}, hallucination rate {n['hallucination_rate']}, "
+            f"{n['latency_mean_s']:.2f}s/note, {n['tokens_per_note']:.0f} tokens/note"
+        )
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, ensure_ascii=False, indent=2), encoding="utf-8")
+        print(f"[Evaluation] Results saved to: {args.output}")
@@ -1,6 +1,7 @@
 # services/file_utils.py
 import tempfile
 import os
+import subprocess
 from pydub import AudioSegment  
 
 def save_upload_tmp(file_bytes: bytes, suffix=".wav") -> str:
@@ -20,4 +21,12 @@ def convert_to_mono_16khz(audio_path: str, output_path: str = None) -> str:
     if not output_path:
         output_path = audio_path.replace(".wav", "_mono.wav")
     audio.export(output_path, format="wav")
-    return output_path
\ No newline at end of file
+    return output_path
+
+def convert_webm_to_wav(webm_path: str) -> str:
+    wav_path = webm_path.replace(".webm", ".wav")
+    # using ffmpeg to convert webm -> wav
+    subprocess.run([
+        "ffmpeg", "-y", "-i", webm_path, "-ar", "16000", "-ac", "1", wav_path
+    ], check=True)
+    return wav_path
@@ -1,14 +1,73 @@
-import os, json, argparse, requests, sys
+import os, json, argparse, requests, sys, threading
 from pathlib import Path
+from app.services.note_schema import (
+    template_to_schema, get_validator, is_valid, find_invalid_fields, get_sub_schema,
+    set_field, strip_extra_fields, field_repair_schema, empty_value,
+)
+from app.services.llm_router import get_pool
+import fastjsonschema
 
 DEF_URL = os.environ.get("OLLAMA_URL", "http://localhost:11434")
 DEF_MODEL = os.environ.get("OLLAMA_MODEL", "qwen3:4b-instruct")
 
+REPAIR_PROMPT = """You previously converted a medical consultation transcription into a structured note,
+but the field "<<FIELD>>" was missing or invalid.
+Extract ONLY this field from the transcription. Use null (or an empty list) if the transcription does not state it.
+Never infer or invent clinical information.
+
+Return a JSON object of the form {"value": ...} where value matches this schema:
+<<SCHEMA>>
+
+SCRIPT:
+<<TRANSCRIPTION>>
+"""
+
+# Process-wide counters (a new OllamaProcessor is created per request)
+_STATS_LOCK = threading.Lock()
+GENERATION_STATS = {
+    "notes": 0,
+    "notes_repaired": 0,
+    "notes_regenerated": 0,
+    "notes_invalid": 0,
+    "fields_repaired": 0,
+    "fields_defaulted": 0,
+    "requests": 0,
+    "prompt_tokens": 0,
+    "completion_tokens": 0,
+    "repair_prompt_tokens": 0,
+    "repair_completion_tokens": 0,
+}
+
+
+def get_generation_stats() -> dict:
+    """Snapshot of the structured-output counters, including repair rate and token cost."""
+    with _STATS_LOCK:
+        stats = dict(GENERATION_STATS)
+    notes = stats["notes"] or 1
+    stats["repair_rate"] = stats["notes_repaired"] / notes
+    stats["avg_tokens_per_note"] = (stats["prompt_tokens"] + stats["completion_tokens"]) / notes
+    return stats
+
+
 class OllamaProcessor:
-    def __init__(self, model: str = DEF_MODEL, url: str = DEF_URL, temperature: float = 0.0):
-        self.url = url or os.environ.get("OLLAMA_URL", "http://localhost:11434")
+    def __init__(
+        self,
+        model: str = DEF_MODEL,
+        url: str = None,
+        temperature: float = 0.0,
+        provider: str = None,
+        endpoints: list = None,
+    ):
+        """
+        - url / endpoints: one base URL, or several (list or comma-separated) to load-balance across.
+          Defaults to OLLAMA_URLS, then OLLAMA_URL.
+        - provider: "ollama" (default) or "openai" for any OpenAI-compatible server.
+        """
         self.model = model or os.environ.get("OLLAMA_MODEL", "qwen3:4b-instruct")
         self.temperature = temperature
+        self.pool = get_pool(endpoints or url, provider=provider)
+        self.url = self.pool.backends[0].url
+        self.last_report = {}
 
     def load_prompt(
         self,
@@ -39,26 +98,25 @@ class OllamaProcessor:
 
         return prompt_text
 
-    def generate(self, prompt: str) -> dict:
-        """Call Ollama locally with JSON output enforced."""
+    def generate(self, prompt: str, schema: dict = None, repair: bool = False) -> dict:
+        """
+        Call the LLM backend pool with JSON output enforced.
+        If a JSON Schema is given it is passed as the structured-outputs `format`.
+        """
         try:
-            resp = requests.post(
-                f"{self.url}/api/generate",
-                json={
-                    "model": self.model,
-                    "prompt": prompt,
-                    "format": "json",
-                    "options": {"temperature": self.temperature},
-                    "stream": False
-                },
+            body = self.pool.generate(
+                self.model,
+                prompt,
+                fmt=schema or "json",
+                temperature=self.temperature,
                 timeout=120
             )
-            resp.raise_for_status()
         except requests.RequestException as e:
             print(f"[OllamaProcessor] Request failed: {e}")
             return {}
 
-        text = resp.json().get("response", "").strip()
+        self._record_usage(body, repair=repair)
+        text = body.get("response", "").strip()
 
         # Try to extract JSON substring if the response is messy
         if not text.startswith("{"):
@@ -72,6 +130,99 @@ class OllamaProcessor:
             print("[OllamaProcessor] ⚠️ Model output not valid JSON, returning raw text.")
             return text
 
+    def _record_usage(self, body: dict, repair: bool = False):
+        prompt_tokens = body.get("prompt_eval_count", 0) or 0
+        completion_tokens = body.get("eval_count", 0) or 0
+        self.last_report["requests"] = self.last_report.get("requests", 0) + 1
+        self.last_report["prompt_tokens"] = self.last_report.get("prompt_tokens", 0) + prompt_tokens
+        self.last_report["completion_tokens"] = self.last_report.get("completion_tokens", 0) + completion_tokens
+        with _STATS_LOCK:
+            GENERATION_STATS["requests"] += 1
+            GENERATION_STATS["prompt_tokens"] += prompt_tokens
+            GENERATION_STATS["completion_tokens"] += completion_tokens
+            if repair:
+                GENERATION_STATS["repair_prompt_tokens"] += prompt_tokens
+                GENERATION_STATS["repair_completion_tokens"] += completion_tokens
+
+    def repair_field(self, transcription: str, schema: dict, path: tuple):
+        """
+        Ask the model for a single missing/invalid field instead of regenerating the whole note.
+        Returns None when the model gives nothing that matches the field schema.
+        """
+        sub_schema = get_sub_schema(schema, path)
+        prompt = REPAIR_PROMPT.replace("<<FIELD>>", ".".join(path))
+        prompt = prompt.replace("<<SCHEMA>>", json.dumps(sub_schema, indent=2))
+        prompt = prompt.replace("<<TRANSCRIPTION>>", transcription)
+        result = self.generate(prompt, schema=field_repair_schema(sub_schema), repair=True)
+        if isinstance(result, dict) and "value" in result and is_valid(sub_schema, result["value"]):
+            return result["value"]
+        return None
+
+    def generate_structured(self, prompt: str, transcription: str, template: dict) -> dict:
+        """
+        Generate a note constrained to the template's JSON Schema, validate it with the
+        precompiled validator and repair only the fields that fail.
+        - unparseable output is regenerated once as a whole (cheaper than one repair per field)
+        - a field whose repair fails gets the template's empty value ({} / [] / null)
+        - the note is validated again after repairs; last_report["valid"] records the outcome
+        """
+        schema = template_to_schema(template)
+        validator = get_validator(schema)
+        self.last_report = {"repaired_fields": [], "defaulted_fields": [], "regenerated": False}
+
+        note = self.generate(prompt, schema=schema)
+        if not self.last_report.get("requests"):
+            # Ollama unreachable — nothing to repair
+            return note
+        if not isinstance(note, dict) or not note:
+            print("[OllamaProcessor] Output not a JSON object, regenerating the whole note once.")
+            self.last_report["regenerated"] = True
+            note = self.generate(prompt, schema=schema)
+            if not isinstance(note, dict) or not note:
+                self._record_note()
+                return {}
+        note = strip_extra_fields(schema, note)
+
+        try:
+            validator(note)
+        except fastjsonschema.JsonSchemaException:
+            for path in find_invalid_fields(schema, note):
+                if not path:
+                    continue
+                field = ".".join(path)
+                print(f"[OllamaProcessor] Repairing field: {field}")
+                value = self.repair_field(transcription, schema, path)
+                if value is None:
+                    # Repair gave nothing usable: leave the field empty rather than invalid
+                    value = empty_value(get_sub_schema(schema, path))
+                    self.last_report["defaulted_fields"].append(field)
+                else:
+                    self.last_report["repaired_fields"].append(field)
+                set_field(note, path, value)
+
+        self.last_report["valid"] = is_valid(schema, note)
+        if not self.last_report["valid"]:
+            print("[OllamaProcessor] ⚠️ Note still fails schema validation after repairs.")
+        self._record_note()
+
+        print(
+            f"[OllamaProcessor] Structured output: {len(self.last_report['repaired_fields'])} field(s) repaired, "
+            f"{self.last_report.get('prompt_tokens', 0)} prompt + "
+            f"{self.last_report.get('completion_tokens', 0)} completion tokens"
+        )
+        return note
+
+    def _record_note(self):
+        report = self.last_report
+        with _STATS_LOCK:
+            GENERATION_STATS["notes"] += 1
+            GENERATION_STATS["notes_regenerated"] += int(report.get("regenerated", False))
+            GENERATION_STATS["notes_invalid"] += int(not report.get("valid", False))
+            if report["repaired_fields"]:
+                GENERATION_STATS["notes_repaired"] += 1
+                GENERATION_STATS["fields_repaired"] += len(report["repaired_fields"])
+            GENERATION_STATS["fields_defaulted"] += len(report["defaulted_fields"])
+
     def process(
         self,
         transcription: str,
@@ -82,6 +233,9 @@ class OllamaProcessor:
         Convenience wrapper — load prompt + template, insert transcription, and query model.
         """
         prompt = self.load_prompt(prompt_path, transcription, template_path)
+        template = json.loads(Path(template_path).read_text(encoding="utf-8"))
+        if isinstance(template, dict) and template:
+            return self.generate_structured(prompt, transcription, template)
         return self.generate(prompt)
 
     
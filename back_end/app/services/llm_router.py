@@ -0,0 +1,409 @@
+# services/llm_router.py
+import os
+import time
+import threading
+import requests
+
+DEF_PROVIDER = os.environ.get("LLM_PROVIDER", "ollama")
+MAX_FAILURES = int(os.environ.get("LLM_MAX_FAILURES", "3"))          # consecutive failures before ejection
+EJECT_SECONDS = float(os.environ.get("LLM_EJECT_SECONDS", "30"))     # how long an ejected node stays out
+HEALTH_INTERVAL = float(os.environ.get("LLM_HEALTH_INTERVAL", "10")) # seconds between health checks
+AFFINITY_PENALTY = int(os.environ.get("LLM_AFFINITY_PENALTY", "2"))  # extra outstanding requests tolerated on a warm node
+MAX_ADHOC_POOLS = int(os.environ.get("LLM_MAX_ADHOC_POOLS", "8"))     # pools for request-supplied URLs kept at once
+ADHOC_POOL_TTL = float(os.environ.get("LLM_ADHOC_POOL_TTL", "600"))   # idle seconds before such a pool is dropped
+
+
+def parse_endpoints(value) -> list:
+    """Accept a comma-separated string or a list of base URLs."""
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = value.split(",")
+    return [v.strip().rstrip("/") for v in value if v and v.strip()]
+
+
+def default_endpoints(provider: str = DEF_PROVIDER) -> list:
+    if provider == "openai":
+        return parse_endpoints(os.environ.get("OPENAI_BASE_URLS") or os.environ.get("OPENAI_BASE_URL", "https://api.openai.com"))
+    return parse_endpoints(os.environ.get("OLLAMA_URLS") or os.environ.get("OLLAMA_URL", "http://localhost:11434"))
+
+
+def configured_endpoints(provider: str = DEF_PROVIDER) -> set:
+    """
+    Endpoints from the environment (defaults plus LLM_ALLOWED_URLS). Only these get background health
+    checks and credentials, and only these may be selected by API clients (see validate_target).
+    """
+    return set(default_endpoints(provider)) | set(parse_endpoints(os.environ.get("LLM_ALLOWED_URLS")))
+
+
+def validate_target(provider: str = None, endpoints=None):
+    """
+    Check a provider / endpoint list supplied by an API client. Raises ValueError for an unknown
+    provider or any URL outside configured_endpoints, so the server never forwards transcripts
+    (or API keys) to arbitrary hosts.
+    """
+    provider = provider or DEF_PROVIDER
+    if provider not in PROVIDERS:
+        raise ValueError(f"Unknown LLM provider '{provider}'. Options: {', '.join(PROVIDERS)}")
+    allowed = configured_endpoints(provider)
+    rejected = [url for url in parse_endpoints(endpoints) if url not in allowed]
+    if rejected:
+        raise ValueError(
+            f"LLM endpoint(s) not allowed: {', '.join(rejected)}. Add them to LLM_ALLOWED_URLS on the server."
+        )
+
+
+def is_node_failure(error: requests.RequestException) -> bool:
+    """
+    Connection errors, timeouts and 5xx say something about the node; 4xx (e.g. a rejected schema)
+    is about the request and would fail on every node, so it must not count towards ejection.
+    """
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    response = getattr(error, "response", None)
+    return response is None or response.status_code >= 500
+
+
+# ---------------- Providers ----------------
+class OllamaProvider:
+    """Native Ollama API (/api/generate)."""
+    name = "ollama"
+
+    def generate(self, base_url: str, model: str, prompt: str, fmt, temperature: float, timeout: float) -> dict:
+        resp = requests.post(
+            f"{base_url}/api/generate",
+            json={
+                "model": model,
+                "prompt": prompt,
+                "format": fmt,
+                "options": {"temperature": temperature},
+                "stream": False
+            },
+            timeout=timeout
+        )
+        resp.raise_for_status()
+        return resp.json()
+
+    def health(self, base_url: str, timeout: float = 2.0) -> set:
+        """Return the models currently held in memory on the node (/api/ps)."""
+        resp = requests.get(f"{base_url}/api/ps", timeout=timeout)
+        resp.raise_for_status()
+        return {m.get("name") or m.get("model") for m in resp.json().get("models", [])}
+
+
+class OpenAIProvider:
+    """Any OpenAI-compatible server (/v1/chat/completions). Responses are normalised to Ollama's shape."""
+    name = "openai"
+
+    def __init__(self, api_key: str = None):
+        self.api_key = api_key or os.environ.get("OPENAI_API_KEY", "")
+
+    def _headers(self) -> dict:
+        return {"Authorization": f"Bearer {self.api_key}"} if self.api_key else {}
+
+    def generate(self, base_url: str, model: str, prompt: str, fmt, temperature: float, timeout: float) -> dict:
+        if isinstance(fmt, dict):
+            response_format = {"type": "json_schema", "json_schema": {"name": "note", "schema": fmt}}
+        else:
+            response_format = {"type": "json_object"}
+        resp = requests.post(
+            f"{base_url}/v1/chat/completions",
+            headers=self._headers(),
+            json={
+                "model": model,
+                "messages": [{"role": "user", "content": prompt}],
+                "temperature": temperature,
+                "response_format": response_format,
+            },
+            timeout=timeout
+        )
+        resp.raise_for_status()
+        body = resp.json()
+        usage = body.get("usage", {})
+        return {
+            "response": body["choices"][0]["message"]["content"],
+            "prompt_eval_count": usage.get("prompt_tokens", 0),
+            "eval_count": usage.get("completion_tokens", 0),
+        }
+
+    def health(self, base_url: str, timeout: float = 2.0) -> set:
+        # OpenAI-compatible servers don't report which models are resident, so no affinity info
+        resp = requests.get(f"{base_url}/v1/models", headers=self._headers(), timeout=timeout)
+        resp.raise_for_status()
+        return set()
+
+
+PROVIDERS = {
+    "ollama": OllamaProvider,
+    "openai": OpenAIProvider,
+}
+
+
+# ---------------- Backend pool ----------------
+class Backend:
+    def __init__(self, url: str):
+        self.url = url
+        self.outstanding = 0
+        self.total_requests = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.loaded_models = set()
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.ejected_until
+
+    def to_dict(self) -> dict:
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "outstanding": self.outstanding,
+            "total_requests": self.total_requests,
+            "consecutive_failures": self.consecutive_failures,
+            "loaded_models": sorted(m for m in self.loaded_models if m),
+        }
+
+
+class BackendPool:
+    def __init__(
+        self,
+        endpoints: list,
+        provider: str = DEF_PROVIDER,
+        max_failures: int = MAX_FAILURES,
+        eject_seconds: float = EJECT_SECONDS,
+        health_interval: float = HEALTH_INTERVAL,
+        affinity_penalty: int = AFFINITY_PENALTY,
+        trusted: bool = True,
+    ):
+        """
+        Route LLM requests across several endpoints:
+        - least outstanding requests first
+        - nodes that already hold the model in memory are preferred (model affinity), unless they are
+          more than `affinity_penalty` requests busier than a cold node
+        - nodes failing `max_failures` times in a row are ejected for `eject_seconds`
+        - trusted=False (endpoints not configured on the server): no credentials are sent
+        """
+        if not endpoints:
+            raise ValueError("BackendPool needs at least one endpoint")
+        if provider not in PROVIDERS:
+            raise ValueError(f"Unknown LLM provider '{provider}'. Options: {', '.join(PROVIDERS)}")
+        self.provider = PROVIDERS[provider]()
+        if not trusted and isinstance(self.provider, OpenAIProvider):
+            self.provider.api_key = ""
+        self.backends = [Backend(url) for url in parse_endpoints(endpoints)]
+        self.max_failures = max_failures
+        self.eject_seconds = eject_seconds
+        self.health_interval = health_interval
+        self.affinity_penalty = affinity_penalty
+        self._lock = threading.Lock()
+        self._health_thread = None
+        self._stop = threading.Event()
+
+    def _pick(self, model: str, exclude: set) -> Backend:
+        with self._lock:
+            candidates = [b for b in self.backends if b.url not in exclude and b.healthy]
+            if not candidates:
+                # Everything is ejected: try the node that is due back soonest rather than failing outright
+                candidates = sorted(
+                    (b for b in self.backends if b.url not in exclude), key=lambda b: b.ejected_until
+                )[:1]
+            if not candidates:
+                return None
+            backend = min(
+                candidates,
+                key=lambda b: (
+                    b.outstanding + (0 if model in b.loaded_models else self.affinity_penalty),
+                    model not in b.loaded_models,
+                    b.total_requests,
+                ),
+            )
+            backend.outstanding += 1
+            backend.total_requests += 1
+            return backend
+
+    def _mark_success(self, backend: Backend, model: str = None):
+        with self._lock:
+            backend.consecutive_failures = 0
+            backend.ejected_until = 0.0
+            if model:
+                backend.loaded_models.add(model)
+
+    def _mark_failure(self, backend: Backend):
+        with self._lock:
+            backend.consecutive_failures += 1
+            if backend.consecutive_failures >= self.max_failures:
+                backend.ejected_until = time.monotonic() + self.eject_seconds
+                print(f"[BackendPool] Ejecting {backend.url} for {self.eject_seconds:.0f}s")
+
+    def generate(self, model: str, prompt: str, fmt="json", temperature: float = 0.0, timeout: float = 120) -> dict:
+        """Send one generate request, failing over to the next best node on node errors (not on 4xx)."""
+        tried = set()
+        last_error = None
+        while True:
+            backend = self._pick(model, tried)
+            if backend is None:
+                break
+            tried.add(backend.url)
+            try:
+                body = self.provider.generate(backend.url, model, prompt, fmt, temperature, timeout)
+                self._mark_success(backend, model)
+                return body
+            except requests.RequestException as e:
+                print(f"[BackendPool] {backend.url} failed: {e}")
+                if not is_node_failure(e):
+                    raise
+                self._mark_failure(backend)
+                last_error = e
+            finally:
+                with self._lock:
+                    backend.outstanding -= 1
+        raise last_error or requests.ConnectionError("No LLM backends available")
+
+    def check_health(self):
+        for backend in self.backends:
+            try:
+                models = self.provider.health(backend.url)
+            except requests.RequestException as e:
+                if is_node_failure(e):
+                    self._mark_failure(backend)
+                continue
+            with self._lock:
+                backend.loaded_models = set(models)
+            self._mark_success(backend)
+
+    def start_health_checks(self):
+        if self._health_thread is not None or self.health_interval <= 0:
+            return
+
+        def loop():
+            while not self._stop.is_set():
+                self.check_health()
+                self._stop.wait(self.health_interval)
+
+        self._health_thread = threading.Thread(target=loop, name="llm-health", daemon=True)
+        self._health_thread.start()
+
+    def close(self):
+        self._stop.set()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"provider": self.provider.name, "backends": [b.to_dict() for b in self.backends]}
+
+
+# One pool per (provider, endpoints) so counters are shared across requests.
+# Pools for configured endpoints live for the process and are health-checked in the background.
+# Pools for URLs supplied in a request (ollama_url form field) are never polled, are capped at
+# MAX_ADHOC_POOLS and dropped after ADHOC_POOL_TTL idle seconds.
+_POOLS = {}
+_ADHOC_LAST_USED = {}
+_POOLS_LOCK = threading.Lock()
+
+
+def _evict_adhoc_pools(now: float):
+    # Caller holds _POOLS_LOCK
+    for key, last_used in list(_ADHOC_LAST_USED.items()):
+        if now - last_used > ADHOC_POOL_TTL:
+            _POOLS.pop(key).close()
+            del _ADHOC_LAST_USED[key]
+    while len(_ADHOC_LAST_USED) > MAX_ADHOC_POOLS:
+        key = min(_ADHOC_LAST_USED, key=_ADHOC_LAST_USED.get)
+        _POOLS.pop(key).close()
+        del _ADHOC_LAST_USED[key]
+
+
+def get_pool(endpoints=None, provider: str = None) -> BackendPool:
+    provider = provider or DEF_PROVIDER
+    endpoints = parse_endpoints(endpoints) or default_endpoints(provider)
+    key = (provider, tuple(endpoints))
+    adhoc = not set(endpoints) <= configured_endpoints(provider)
+    now = time.monotonic()
+    with _POOLS_LOCK:
+        pool = _POOLS.get(key)
+        if pool is None:
+            pool = BackendPool(endpoints, provider=provider, trusted=not adhoc)
+            if not adhoc:
+                pool.start_health_checks()
+            _POOLS[key] = pool
+        if adhoc:
+            _ADHOC_LAST_USED[key] = now
+            _evict_adhoc_pools(now)
+    return pool
+
+
+def all_pool_stats() -> list:
+    with _POOLS_LOCK:
+        pools = list(_POOLS.values())
+    return [p.stats() for p in pools]
+
+
+if __name__ == "__main__":
+    # Spin up local stub Ollama servers and route a burst of requests across them
+    import json
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from concurrent.futures import ThreadPoolExecutor
+
+    def make_stub(delay: float, fail: bool = False, loaded=(), reject: bool = False):
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _send(self, code, payload):
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self._send(200, {"models": [{"name": m} for m in loaded]})
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                time.sleep(delay)
+                if fail:
+                    self._send(500, {"error": "stub failure"})
+                elif reject:
+                    self._send(400, {"error": "invalid format schema"})
+                else:
+                    self._send(200, {"response": "{}", "prompt_eval_count": 1, "eval_count": 1})
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{server.server_address[1]}"
+
+    urls = [
+        make_stub(0.05, loaded=("qwen3:4b-instruct",)),
+        make_stub(0.05),
+        make_stub(0.05, fail=True),
+    ]
+    pool = BackendPool(urls, provider="ollama", health_interval=0)
+    pool.check_health()
+
+    with ThreadPoolExecutor(max_workers=8) as ex:
+        list(ex.map(lambda _: pool.generate("qwen3:4b-instruct", "hi"), range(40)))
+
+    print(json.dumps(pool.stats(), indent=2))
+    warm, cold, failing = pool.backends
+    assert not failing.healthy, "failing node should be ejected"
+    assert warm.total_requests >= cold.total_requests, "warm node should be preferred"
+    assert warm.total_requests + cold.total_requests >= 40, "every request should succeed via failover"
+
+    # A 4xx is the request's fault: no failover, no ejection
+    rejecting = BackendPool([make_stub(0.0, reject=True), make_stub(0.0, reject=True)], health_interval=0)
+    for _ in range(MAX_FAILURES + 1):
+        try:
+            rejecting.generate("qwen3:4b-instruct", "hi")
+            raise AssertionError("400 should propagate")
+        except requests.HTTPError:
+            pass
+    assert all(b.healthy and b.consecutive_failures == 0 for b in rejecting.backends), "4xx must not eject"
+    assert sum(b.total_requests for b in rejecting.backends) == MAX_FAILURES + 1, "4xx must not fail over"
+
+    # Request-supplied URLs: no health thread, capped registry
+    for i in range(MAX_ADHOC_POOLS + 3):
+        adhoc = get_pool(f"http://127.0.0.1:{40000 + i}")
+        assert adhoc._health_thread is None
+    assert len(_ADHOC_LAST_USED) == MAX_ADHOC_POOLS
+    print("OK")
@@ -1,7 +1,5 @@
 # services/model_manager.py
 import os
-# from nemo.collections.asr.models import ASRModel
-# from nemo.collections.speechlm2.models import SALM
 # Inside app/services/model_manager.py
 from app.services.file_utils import convert_to_mono_16khz
 
@@ -20,6 +18,9 @@ class NeMoModelManager:
         if self._parakeet_model:
             return self._parakeet_model
 
+        # NeMo is an optional, heavy dependency: only import it when a NeMo model is requested
+        from nemo.collections.asr.models import ASRModel
+
         if os.path.exists(self.parakeet_path):
             print("[ModelManager] Restoring Parakeet from .nemo file...")
             self._parakeet_model = ASRModel.restore_from(self.parakeet_path)
@@ -34,6 +35,8 @@ class NeMoModelManager:
         if self._canary_model:
             return self._canary_model
 
+        from nemo.collections.speechlm2.models import SALM
+
         if os.path.exists(self.canary_path):
             print("[ModelManager] Restoring Canary Qwen from .nemo file...")
             self._canary_model = SALM.restore_from(self.canary_path)
@@ -45,9 +48,11 @@ class NeMoModelManager:
 
 import os
 import torch
-# import whisper
 from faster_whisper import WhisperModel, BatchedInferencePipeline
 
+# faster-whisper decode settings used in production; stt_calibration benchmarks with the same ones
+DECODE_OPTIONS = {"beam_size": 5}
+
 class WhisperModelManager:
     def __init__(self, model_dir=None, use_faster=True):
         """
@@ -63,56 +68,86 @@ class WhisperModelManager:
         self.batched_models = {}
         self.use_faster = use_faster
 
-    def load_model(self, model_name=None, compute_type=None, batched_model=False):
+    def load_model(self, model_name=None, compute_type=None, batched_model=False, expected_concurrency=None):
         """
         Loads Whisper model with caching and device awareness.
         - model_name: str, name of the model (tiny, base, small, medium, large, turbo, etc.)
         - compute_type: 'float16', 'int8', etc. (only for faster-whisper)
+        - expected_concurrency: concurrent streams this model will serve; on CPU the calibrated
+          profile for that concurrency (see stt_calibration) sets compute type, cpu_threads and num_workers
         """
         # Set default models based on device
         if not model_name:
             model_name = "medium.en" if self.device == "cuda" else "tiny.en"
 
         if self.use_faster:
+            cpu_threads, num_workers = 0, 1  # CTranslate2 defaults
+            if self.device == "cpu" and compute_type is None:
+                from app.services.stt_calibration import load_profile, EXPECTED_CONCURRENCY
+                profile = load_profile(model_name, expected_concurrency or EXPECTED_CONCURRENCY)
+                if profile:
+                    compute_type = profile["compute_type"]
+                    cpu_threads, num_workers = profile["cpu_threads"], profile["num_workers"]
+                    print(f"[WhisperModelManager] Using calibrated profile: {profile}")
             compute_type = compute_type or ("float16" if self.device == "cuda" else "int8")
             print(f"[WhisperModelManager] Loading faster-whisper model {model_name} ({compute_type}) on {self.device}")
-            model = WhisperModel(model_name, device=self.device, compute_type=compute_type, download_root=self.model_dir)
+            model = WhisperModel(
+                model_name,
+                device=self.device,
+                compute_type=compute_type,
+                cpu_threads=cpu_threads,
+                num_workers=num_workers,
+                download_root=self.model_dir
+            )
 
             # Wrap in batched inference if requested
             if batched_model:
+                # Keep the base model too, so sequential transcribe() works without a second load
+                self.models["whisper"] = model
                 print(f"[WhisperModelManager] Wrapping model {model_name} in BatchedInferencePipeline...")
                 model = BatchedInferencePipeline(model)
 
                 self.batched_models["batched_whisper"] = model
                 print("[WhisperModelManager] Batched Model loaded successfully.")
                 return model
-        # else:
-        #     print(f"[WhisperModelManager] Loading OpenAI Whisper model {model_name} on {self.device}")
-        #     model = whisper.load_model(model_name, device=self.device)
+        else:
+            # openai-whisper is optional: only import it when requested
+            import whisper
+            print(f"[WhisperModelManager] Loading OpenAI Whisper model {model_name} on {self.device}")
+            model = whisper.load_model(model_name, device=self.device, download_root=self.model_dir)
         self.models["whisper"] = model
         print("[WhisperModelManager] Model loaded successfully.")
         return model
     
-    def transcribe(self, audio_path: str) -> str:
+    def transcribe_segments(self, audio_path) -> list:
         """
-        Transcribe a single audio file using the loaded model.
+        Transcribe a single audio file and keep Whisper's segment timestamps.
+        Returns a list of {"start", "end", "text"} dicts (seconds).
+        audio_path may also be a float32 mono 16kHz numpy array (e.g. a range read from the audio archive).
         """
         if "whisper" not in self.models:
             raise RuntimeError("No model loaded. Call load_model() first.")
         
         model = self.models["whisper"]
-        mono_path = convert_to_mono_16khz(audio_path)
-        print(f"[WhisperModelManager] Transcribing: {mono_path}")
+        if isinstance(audio_path, str):
+            mono_path = convert_to_mono_16khz(audio_path)
+            print(f"[WhisperModelManager] Transcribing: {mono_path}")
+        else:
+            mono_path = audio_path
+            print(f"[WhisperModelManager] Transcribing {len(mono_path) / 16000:.1f}s of audio")
 
         if self.use_faster:
             # Faster-whisper supports both direct and batched modes automatically
-            segments, info = model.transcribe(mono_path, log_progress=True)
-            text = " ".join([seg.text for seg in segments])
-        else:
-            result = model.transcribe(mono_path)
-            text = result["text"]
+            segments, info = model.transcribe(mono_path, log_progress=True, **DECODE_OPTIONS)
+            return [{"start": seg.start, "end": seg.end, "text": seg.text} for seg in segments]
+        result = model.transcribe(mono_path)
+        return [{"start": seg["start"], "end": seg["end"], "text": seg["text"]} for seg in result["segments"]]
 
-        return text
+    def transcribe(self, audio_path) -> str:
+        """
+        Transcribe a single audio file using the loaded model.
+        """
+        return " ".join(seg["text"] for seg in self.transcribe_segments(audio_path))
     
     def batched_transcribe(self, audio_path, batched_size: int = 16) -> dict:
         """
@@ -125,7 +160,7 @@ class WhisperModelManager:
         results = {}
         print(f"[WhisperModelManager] Starting batched transcription")
 
-        mono_path = convert_to_mono_16khz(audio_path)
+        mono_path = convert_to_mono_16khz(audio_path) if isinstance(audio_path, str) else audio_path
         if self.use_faster:
             segments, info = model.transcribe(mono_path, batch_size = batched_size, log_progress = True)
             text = " ".join([seg.text for seg in segments])
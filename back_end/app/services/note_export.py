@@ -0,0 +1,347 @@
+# services/note_export.py
+import io
+import os
+import json
+import html
+import zipfile
+import time
+import shutil
+import hashlib
+import threading
+import multiprocessing
+from datetime import datetime
+from functools import lru_cache
+from pathlib import Path
+from string import Template
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+EXPORT_DIR = Path(os.environ.get("EXPORT_DIR", Path(__file__).resolve().parents[2] / "exports"))
+EXPORT_WORKERS = int(os.environ.get("EXPORT_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+EXPORT_MAX_BYTES = int(os.environ.get("EXPORT_MAX_BYTES", str(512 * 1024 * 1024)))
+EXPORT_MAX_AGE_DAYS = float(os.environ.get("EXPORT_MAX_AGE_DAYS", "7"))  # rendered notes are patient data: keep briefly
+RENDER_VERSION = "1"  # bump when the layout changes, so cached artifacts are not reused
+FORMATS = {"pdf": "application/pdf", "docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document"}
+
+NOTE_CSS = """
+@page { size: A4; margin: 18mm 16mm; @bottom-right { content: counter(page) " / " counter(pages); font-size: 8pt; color: #666; } }
+body { font-family: "DejaVu Sans", "Liberation Sans", Arial, sans-serif; font-size: 10pt; color: #111; }
+h1 { font-size: 16pt; margin: 0 0 2mm 0; }
+.meta { color: #555; font-size: 9pt; margin-bottom: 6mm; }
+h2 { font-size: 11.5pt; border-bottom: 1px solid #bbb; padding-bottom: 1mm; margin: 5mm 0 2mm 0; }
+table { width: 100%; border-collapse: collapse; }
+td { vertical-align: top; padding: 1mm 2mm; }
+td.label { width: 32%; color: #444; font-weight: bold; }
+ul { margin: 0; padding-left: 5mm; }
+"""
+
+class RendererUnavailable(RuntimeError):
+    """The renderer for a format cannot run on this host (missing package or system library)."""
+
+
+HTML_TEMPLATE = Template("""<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>$title</title></head>
+<body>
+<h1>$title</h1>
+<div class="meta">$meta</div>
+$sections
+</body></html>
+""")
+
+
+# ---------------- Content -> sections ----------------
+def _label(key: str) -> str:
+    return str(key).replace("_", " ").strip().capitalize()
+
+
+def _is_empty(value) -> bool:
+    return value is None or value == "" or value == [] or value == {}
+
+
+def _rows(value, prefix: str = "") -> list:
+    """Flatten a nested note value into (label, value) rows; lists stay lists, empty fields are skipped."""
+    if isinstance(value, dict):
+        rows = []
+        for key, sub in value.items():
+            label = f"{prefix} – {_label(key)}" if prefix else _label(key)
+            rows.extend(_rows(sub, label))
+        return rows
+    if _is_empty(value):
+        return []
+    if isinstance(value, list):
+        items = [json.dumps(v, ensure_ascii=False) if isinstance(v, (dict, list)) else str(v) for v in value if not _is_empty(v)]
+        return [(prefix, items)] if items else []
+    return [(prefix, str(value))]
+
+
+def note_sections(content) -> list:
+    """Top-level fields become sections: [(heading, [(label, value or [items])])]."""
+    if not isinstance(content, dict):
+        return [("Note", [("", str(content))])] if not _is_empty(content) else []
+    sections = []
+    for key, value in content.items():
+        rows = _rows(value) if isinstance(value, dict) else _rows(value, "")
+        if rows:
+            sections.append((_label(key), rows))
+    return sections
+
+
+def _meta(session: dict) -> str:
+    created = session.get("createdAt")
+    if isinstance(created, (int, float)):
+        # Frontend stores milliseconds since epoch
+        created = datetime.fromtimestamp(created / 1000 if created > 1e11 else created).strftime("%Y-%m-%d %H:%M")
+    return f"Session {session.get('id', '')}" + (f" · {created}" if created else "")
+
+
+# ---------------- Cached render resources (built once per process) ----------------
+@lru_cache(maxsize=1)
+def _pdf_resources():
+    from weasyprint import CSS
+    from weasyprint.text.fonts import FontConfiguration
+
+    fonts = FontConfiguration()
+    return CSS(string=NOTE_CSS, font_config=fonts), fonts
+
+
+@lru_cache(maxsize=1)
+def _docx_base() -> bytes:
+    """Base document with styles configured once; each render starts from a copy of it."""
+    from docx import Document
+    from docx.shared import Pt
+
+    doc = Document()
+    normal = doc.styles["Normal"]
+    normal.font.name = "Arial"
+    normal.font.size = Pt(10)
+    for style_name, size in (("Heading 1", 16), ("Heading 2", 11.5)):
+        doc.styles[style_name].font.size = Pt(size)
+    buf = io.BytesIO()
+    doc.save(buf)
+    return buf.getvalue()
+
+
+def warm_up():
+    """Pool initializer: parse CSS, load fonts and build the DOCX base before the first job."""
+    # Best effort: a missing system library (e.g. pango for weasyprint) must not break the pool,
+    # the error surfaces on the render that needs it instead
+    for build in (_pdf_resources, _docx_base):
+        try:
+            build()
+        except (ImportError, OSError) as e:
+            print(f"[NoteExport] Warm-up skipped for {build.__name__}: {e}")
+
+
+# ---------------- Renderers ----------------
+def render_html(session: dict) -> str:
+    parts = []
+    for heading, rows in note_sections(session.get("content", {})):
+        cells = []
+        for label, value in rows:
+            if isinstance(value, list):
+                value_html = "<ul>" + "".join(f"<li>{html.escape(v)}</li>" for v in value) + "</ul>"
+            else:
+                value_html = html.escape(value).replace("\n", "<br>")
+            cells.append(f'<tr><td class="label">{html.escape(label)}</td><td>{value_html}</td></tr>')
+        parts.append(f"<h2>{html.escape(heading)}</h2><table>{''.join(cells)}</table>")
+    return HTML_TEMPLATE.substitute(
+        title=html.escape(session.get("title") or "Clinical note"),
+        meta=html.escape(_meta(session)),
+        sections="\n".join(parts),
+    )
+
+
+def render_pdf(session: dict) -> bytes:
+    from weasyprint import HTML
+
+    css, fonts = _pdf_resources()
+    return HTML(string=render_html(session)).write_pdf(stylesheets=[css], font_config=fonts)
+
+
+def render_docx(session: dict) -> bytes:
+    from docx import Document
+
+    doc = Document(io.BytesIO(_docx_base()))
+    doc.add_heading(session.get("title") or "Clinical note", level=1)
+    doc.add_paragraph(_meta(session))
+    for heading, rows in note_sections(session.get("content", {})):
+        doc.add_heading(heading, level=2)
+        for label, value in rows:
+            if isinstance(value, list):
+                if label:
+                    doc.add_paragraph().add_run(f"{label}:").bold = True
+                for item in value:
+                    doc.add_paragraph(item, style="List Bullet")
+            else:
+                para = doc.add_paragraph()
+                if label:
+                    para.add_run(f"{label}: ").bold = True
+                para.add_run(value)
+    buf = io.BytesIO()
+    doc.save(buf)
+    return buf.getvalue()
+
+
+RENDERERS = {"pdf": render_pdf, "docx": render_docx}
+
+
+def _render_to_file(session: dict, fmt: str, path: str) -> str:
+    """Runs in a worker process: render and atomically write the artifact."""
+    try:
+        data = RENDERERS[fmt](session)
+    except (ImportError, OSError) as e:
+        # weasyprint raises OSError when pango/cairo are missing
+        raise RendererUnavailable(
+            f"{fmt.upper()} export is unavailable on this server ({e}). "
+            f"Install {'weasyprint and its system libraries (pango)' if fmt == 'pdf' else 'python-docx'}."
+        ) from None
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return path
+
+
+# ---------------- Cache + process pool ----------------
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+def _pool() -> ProcessPoolExecutor:
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            # spawn, not fork: the server process already runs Whisper/torch, health-check and timer threads,
+            # and forking a process holding their locks can deadlock the children
+            _POOL = ProcessPoolExecutor(
+                max_workers=EXPORT_WORKERS,
+                initializer=warm_up,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _POOL
+
+
+def _reset_pool(broken: ProcessPoolExecutor):
+    """Replace a pool whose worker died (a broken pool rejects every later submit)."""
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is broken:
+            _POOL = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+
+def _render_all(jobs: dict, fmt: str):
+    """Render {path: session} in the pool; if a worker crash broke the pool, start a new one and retry once."""
+    for attempt in range(2):
+        pool = _pool()
+        try:
+            futures = [
+                pool.submit(_render_to_file, session, fmt, str(path))
+                for path, session in jobs.items() if not path.exists()
+            ]
+            for future in futures:
+                future.result()
+            return
+        except BrokenProcessPool:
+            _reset_pool(pool)
+            if attempt:
+                raise
+            print("[NoteExport] Render pool broken, restarting it")
+
+
+def artifact_key(session: dict, fmt: str) -> str:
+    """Content hash of everything that affects the rendered output."""
+    payload = {
+        "v": RENDER_VERSION,
+        "fmt": fmt,
+        "id": session.get("id"),
+        "title": session.get("title"),
+        "createdAt": session.get("createdAt"),
+        "content": session.get("content"),
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def _session_dir(session_id) -> Path:
+    return EXPORT_DIR / str(session_id)
+
+
+def _artifact_path(session: dict, fmt: str) -> Path:
+    """Artifacts live per session (so they can be removed with it), named by content hash."""
+    if fmt not in FORMATS:
+        raise ValueError(f"Unsupported export format '{fmt}'. Options: {', '.join(FORMATS)}")
+    session_dir = _session_dir(session.get("id"))
+    session_dir.mkdir(parents=True, exist_ok=True)
+    return session_dir / f"{artifact_key(session, fmt)}.{fmt}"
+
+
+def export_sessions(sessions: list, fmt: str) -> list:
+    """Render sessions in the process pool (in parallel); already-rendered content is served from cache."""
+    paths = [_artifact_path(session, fmt) for session in sessions]
+    jobs = {}
+    for session, path in zip(sessions, paths):
+        if path.exists():
+            os.utime(path)  # mtime = last use, for retention
+        else:
+            jobs.setdefault(path, session)
+    # Older renders of a session are left to enforce_retention: one may still be streaming to a client
+    _render_all(jobs, fmt)
+    print(f"[NoteExport] {len(sessions)} {fmt} export(s), {len(jobs)} rendered, {len(sessions) - len(jobs)} cached")
+    enforce_retention(keep=set(paths))
+    return paths
+
+
+def delete_session_exports(session_id: str):
+    """Remove every rendered artifact of a session (called when the session is deleted)."""
+    shutil.rmtree(_session_dir(session_id), ignore_errors=True)
+
+
+def enforce_retention(max_bytes: int = EXPORT_MAX_BYTES, max_age_days: float = EXPORT_MAX_AGE_DAYS, keep: set = ()) -> int:
+    """Drop artifacts unused for `max_age_days`, then least recently used ones until under `max_bytes`."""
+    now = time.time()
+    files = []
+    for path in EXPORT_DIR.glob("*/*"):
+        if path in keep or path.suffix == ".tmp":
+            continue
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, path))
+    files.sort()
+    total = sum(size for _, size, _ in files)
+    removed = 0
+    for mtime, size, path in files:
+        if now - mtime <= max_age_days * 86400 and total <= max_bytes:
+            break
+        path.unlink(missing_ok=True)
+        total -= size
+        removed += 1
+    if removed:
+        print(f"[NoteExport] Retention removed {removed} artifact(s)")
+    return removed
+
+
+def export_session(session: dict, fmt: str) -> Path:
+    return export_sessions([session], fmt)[0]
+
+
+def export_zip(sessions: list, fmt: str) -> bytes:
+    """Bulk export: one file per session, bundled in a zip."""
+    paths = export_sessions(sessions, fmt)
+    buf = io.BytesIO()
+    used = set()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+        for session, path in zip(sessions, paths):
+            name = export_filename(session, fmt)
+            if name in used:
+                name = f"{session.get('id')}-{name}"
+            used.add(name)
+            zf.write(path, name)
+    return buf.getvalue()
+
+
+def export_filename(session: dict, fmt: str) -> str:
+    title = session.get("title") or session.get("id") or "note"
+    safe = "".join(c if c.isalnum() or c in " -_" else "_" for c in title).strip() or "note"
+    return f"{safe}.{fmt}"
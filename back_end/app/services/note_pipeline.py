@@ -0,0 +1,279 @@
+# services/note_pipeline.py
+import os
+import json
+import time
+import asyncio
+import shutil
+import tempfile
+import soundfile as sf
+from pathlib import Path
+from app.api.routes.sessions import session_file_path, update_session
+from app.services.diarization import diarize_segments, format_labelled_transcript
+from app.services.file_utils import convert_to_mono_16khz, convert_webm_to_wav
+from app.services.llm_ollama_services import OllamaProcessor
+from app.services.scheduler import SCHEDULER
+from app.services.stt_engines import get_engine, supports_timestamps
+from app.utils.job_store import JobStore, sha256_bytes, sha256_file
+from app.utils.storage import read_json
+
+PROMPT_PATH = Path(__file__).resolve().parents[1] / "note_structuring_prompt.txt"
+JOB_STORE = JobStore()
+
+# Jobs being run by this process. A persisted "running" status alone may be left over from a crash,
+# so only this set tells whether a job is actually in progress. Only touched from the event loop.
+_ACTIVE_JOBS = set()
+
+
+class JobAlreadyRunning(RuntimeError):
+    def __init__(self, job_id: str):
+        super().__init__(f"Job {job_id} is already running.")
+        self.job_id = job_id
+
+
+def _content_hash(content) -> str:
+    return sha256_bytes(json.dumps(content, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+
+
+def make_job_id(session_id: str, audio_bytes: bytes, params: dict, content=None) -> str:
+    """
+    Same session + same audio + same settings + same session content -> same job, so retries resume
+    instead of redoing work, while a re-run after the note was edited starts a new job.
+    """
+    digest = sha256_bytes(audio_bytes + json.dumps(params, sort_keys=True).encode("utf-8"))
+    return f"{session_id}-{digest[:16]}-{_content_hash(content)[:8]}"
+
+
+def _sibling_jobs(store: JobStore, job_id: str) -> list:
+    """Other jobs for the same session/audio/settings (they differ only in the session content)."""
+    base = job_id.rsplit("-", 1)[0]
+    return [path.parent.name for path in store.root.glob(f"{base}-*/job.json") if path.parent.name != job_id]
+
+
+def _reuse_transcript(store: JobStore, job_id: str):
+    """A re-run after the note was edited needs a new LLM pass, not a new transcription."""
+    for other in _sibling_jobs(store, job_id):
+        done = store.completed(other, "transcript")
+        if done and store.artifact_path(other, "transcript.txt").exists():
+            store.save_text(job_id, "transcript.txt", store.read_text(other, "transcript.txt"))
+            store.checkpoint(job_id, "audio", reused_from=other)
+            store.checkpoint(job_id, "transcript", **{**done, "reused_from": other})
+            print(f"[NotePipeline] {job_id}: reusing transcript from {other}")
+            return
+
+
+def _job_that_wrote(store: JobStore, job_id: str, content) -> str:
+    """
+    A finished job for the same session/audio/settings whose notes are the current session content:
+    the request is a retry of that job (the session was replaced by its output and not edited since).
+    """
+    content_hash = _content_hash(content)
+    for other in _sibling_jobs(store, job_id):
+        job = store.get(other)
+        if job and job["status"] == "done" and _content_hash(store.read_json(other, "notes.json")) == content_hash:
+            return other
+    return None
+
+
+def submit_note_job(session_id: str, filename: str, audio_bytes: bytes, params: dict, store: JobStore = JOB_STORE) -> str:
+    """
+    Persist the upload and a snapshot of the session template before any processing starts.
+    Raises KeyError if the session does not exist.
+    """
+    session = read_json(session_file_path(session_id), default=None)
+    if session is None:
+        raise KeyError(f"Session {session_id} not found.")
+    content = session.get("content", {})
+
+    ext = Path(filename).suffix.lower()
+    job_id = make_job_id(session_id, audio_bytes, params, content)
+    new_job = store.get(job_id) is None
+    if new_job:
+        job_id = _job_that_wrote(store, job_id, content) or job_id
+        new_job = store.get(job_id) is None
+    store.create(job_id, {"session_id": session_id, "filename": filename, "ext": ext, **params})
+    if new_job:
+        _reuse_transcript(store, job_id)
+
+    if not store.completed(job_id, "audio") and not store.artifact_path(job_id, f"upload{ext}").exists():
+        store.save_bytes(job_id, f"upload{ext}", audio_bytes)
+
+    if not store.artifact_path(job_id, "template.json").exists():
+        # Snapshot: the session content is replaced at the end, a resumed job must still see the original template
+        store.save_json(job_id, "template.json", content)
+    return job_id
+
+
+def _decode_audio(store: JobStore, job_id: str, ext: str) -> str:
+    """Convert the upload to mono 16kHz WAV inside the job directory."""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        tmp_path = os.path.join(tmpdir, f"upload{ext}")
+        shutil.copy(store.artifact_path(job_id, f"upload{ext}"), tmp_path)
+        if ext == ".webm":
+            tmp_path = convert_webm_to_wav(tmp_path)
+        mono_path = convert_to_mono_16khz(tmp_path)
+        audio_path = store.artifact_path(job_id, "audio.wav")
+        shutil.move(mono_path, audio_path)
+        return str(audio_path)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def _transcribe_stage(store: JobStore, job_id: str, params: dict, engine) -> str:
+    """Blocking STT (+ optional diarization); runs in a worker thread while holding an STT slot."""
+    audio_path = str(store.artifact_path(job_id, "audio.wav"))
+    if params.get("diarize"):
+        # Label clinician/patient turns so the LLM doesn't have to guess who said what
+        segments = engine.transcribe_segments(audio_path)
+        audio, sample_rate = sf.read(audio_path, dtype="float32")
+        segments = diarize_segments(audio, segments, sample_rate=sample_rate)
+        transcription_text = format_labelled_transcript(segments)
+    else:
+        transcription_text = engine.transcribe(audio_path)
+    store.save_text(job_id, "transcript.txt", transcription_text)
+    store.checkpoint(job_id, "transcript", chars=len(transcription_text), engine=engine.name, model=engine.model_name)
+    print(f"[NotePipeline] {job_id}: transcription completed, {len(transcription_text)} chars")
+    return transcription_text
+
+
+def _load_engine(params: dict):
+    engine = get_engine(params.get("stt_engine", "faster-whisper"), params.get("speech_model"))
+    if params.get("diarize") and not supports_timestamps(engine.name):
+        # One untimed segment would label the whole consultation as a single speaker
+        raise ValueError(f"Diarization needs segment timestamps, which the {engine.name} engine does not provide.")
+    return engine
+
+
+def _prompt_stage(store: JobStore, job_id: str, processor: OllamaProcessor, transcription_text: str) -> str:
+    if store.completed(job_id, "prompt"):
+        return store.read_text(job_id, "prompt.txt")
+    prompt = processor.load_prompt(PROMPT_PATH, transcription_text, store.artifact_path(job_id, "template.json"))
+    store.save_text(job_id, "prompt.txt", prompt)
+    store.checkpoint(job_id, "prompt", prompt_hash=sha256_bytes(prompt.encode("utf-8")))
+    return prompt
+
+
+def _notes_stage(store: JobStore, job_id: str, processor: OllamaProcessor, prompt: str, transcription_text: str) -> dict:
+    """Blocking LLM call; runs in a worker thread while holding an LLM slot."""
+    template = store.read_json(job_id, "template.json", default={})
+    if isinstance(template, dict) and template:
+        structured_notes = processor.generate_structured(prompt, transcription_text, template)
+    else:
+        structured_notes = processor.generate(prompt)
+    if not isinstance(structured_notes, dict) or not structured_notes:
+        # Never let an LLM failure overwrite the session content
+        raise RuntimeError("LLM returned no structured note; session left unchanged.")
+    store.save_json(job_id, "notes.json", structured_notes)
+    store.checkpoint(job_id, "notes", report=processor.last_report)
+    return structured_notes
+
+
+def _session_stage(store: JobStore, job_id: str, params: dict, structured_notes: dict):
+    """Transactional session update, then drop the large intermediates."""
+    if not store.completed(job_id, "session"):
+        def replace_content(session: dict) -> dict:
+            session["content"] = structured_notes
+            return session
+
+        update_session(params["session_id"], replace_content)
+        store.checkpoint(job_id, "session")
+        print(f"[NotePipeline] Session {params['session_id']} updated.")
+    store.finish(job_id)
+    store.remove_artifacts(job_id, [f"upload{params['ext']}", "audio.wav"])
+
+
+async def run_note_job(job_id: str, store: JobStore = JOB_STORE, tenant: str = "default",
+                       priority: str = "interactive", deadline_s: float = None, enforce: bool = True) -> dict:
+    """
+    Run (or resume) the pipeline: audio -> transcript -> prompt -> notes -> session.
+    Each completed stage is checkpointed; stages already recorded are skipped.
+    The STT and LLM stages wait (asynchronously, no thread held) for a scheduler slot; tenant, priority
+    and deadline_s decide the order. With enforce=True a full queue raises SchedulerSaturated; the job
+    keeps its checkpoints, so a retry resumes where it stopped.
+    Raises JobAlreadyRunning if this process is already running the job (e.g. a client retry).
+    """
+    if job_id in _ACTIVE_JOBS:
+        raise JobAlreadyRunning(job_id)
+    _ACTIVE_JOBS.add(job_id)
+    try:
+        return await _run_note_job(job_id, store, tenant, priority, deadline_s, enforce)
+    finally:
+        _ACTIVE_JOBS.discard(job_id)
+        await prune_jobs(store)
+
+
+async def _run_note_job(job_id: str, store: JobStore, tenant: str, priority: str, deadline_s: float, enforce: bool) -> dict:
+    job = await asyncio.to_thread(store.get, job_id)
+    if job is None:
+        raise KeyError(f"Job {job_id} not found.")
+    if job["status"] == "done":
+        return await asyncio.to_thread(store.read_json, job_id, "notes.json")
+
+    deadline = time.monotonic() + deadline_s if deadline_s is not None else None
+
+    def remaining():
+        return deadline - time.monotonic() if deadline is not None else None
+
+    await asyncio.to_thread(store.start, job_id)
+    params = job["params"]
+    try:
+        # --- Stage 1: decoded audio ---
+        if not store.completed(job_id, "audio"):
+            audio_path = await asyncio.to_thread(_decode_audio, store, job_id, params["ext"])
+            await asyncio.to_thread(store.checkpoint, job_id, "audio", audio_hash=sha256_file(audio_path))
+
+        # --- Stage 2: transcript ---
+        if store.completed(job_id, "transcript"):
+            transcription_text = store.read_text(job_id, "transcript.txt")
+            print(f"[NotePipeline] {job_id}: reusing checkpointed transcript")
+        else:
+            engine = await asyncio.to_thread(_load_engine, params)
+            async with SCHEDULER.slot_async("stt", tenant, priority, remaining(), enforce):
+                transcription_text = await asyncio.to_thread(_transcribe_stage, store, job_id, params, engine)
+
+        # --- Stage 3: prompt ---
+        processor = OllamaProcessor(
+            model=params.get("llm_model"),
+            url=params.get("ollama_url"),
+            provider=params.get("provider"),
+        )
+        prompt = await asyncio.to_thread(_prompt_stage, store, job_id, processor, transcription_text)
+
+        # --- Stage 4: structured notes ---
+        if store.completed(job_id, "notes"):
+            structured_notes = store.read_json(job_id, "notes.json")
+        else:
+            async with SCHEDULER.slot_async("llm", tenant, priority, remaining(), enforce):
+                structured_notes = await asyncio.to_thread(
+                    _notes_stage, store, job_id, processor, prompt, transcription_text
+                )
+
+        # --- Stage 5: session update (transactional) ---
+        await asyncio.to_thread(_session_stage, store, job_id, params, structured_notes)
+        return structured_notes
+    except Exception as e:
+        store.fail(job_id, str(e))
+        raise
+
+
+async def prune_jobs(store: JobStore = JOB_STORE):
+    """Drop old finished/failed jobs with their transcripts, prompts, notes and leftover audio."""
+    removed = await asyncio.to_thread(store.prune, skip=set(_ACTIVE_JOBS))
+    if removed:
+        print(f"[NotePipeline] Pruned {len(removed)} old job(s)")
+
+
+async def resume_incomplete_jobs(store: JobStore = JOB_STORE):
+    """Resume jobs interrupted by a crash/restart from their last completed stage."""
+    await prune_jobs(store)
+    for job in await asyncio.to_thread(store.incomplete):
+        print(f"[NotePipeline] Resuming job {job['id']} (completed: {', '.join(job['stages']) or 'none'})")
+        try:
+            # Recovered work runs as batch so it doesn't delay live sessions after a restart, and
+            # is not subject to the queue cap (it was admitted before the restart)
+            await run_note_job(job["id"], store, tenant="resume", priority="batch", enforce=False)
+        except JobAlreadyRunning:
+            # A client retry picked it up first
+            continue
+        except Exception as e:
+            print(f"[NotePipeline] Job {job['id']} failed: {e}")
@@ -0,0 +1,124 @@
+# services/note_schema.py
+import copy
+import hashlib
+import json
+from typing import Any, Dict, List, Tuple
+
+import fastjsonschema
+
+# Compiled validators keyed by schema hash, so each session template is only compiled once
+_VALIDATORS: Dict[str, Any] = {}
+
+
+def template_to_schema(template: Any) -> dict:
+    """
+    Convert a session note template (JSON with null/empty placeholders) into a JSON Schema.
+    - dict  -> object with every key required and no extra keys
+    - list  -> array of the first item's schema (strings if the example list is empty)
+    - null  -> string or null
+    - other -> its own type (or null, so the model can leave it empty)
+    """
+    if isinstance(template, dict):
+        return {
+            "type": "object",
+            "properties": {key: template_to_schema(value) for key, value in template.items()},
+            "required": list(template.keys()),
+            "additionalProperties": False,
+        }
+    if isinstance(template, list):
+        items = template_to_schema(template[0]) if template else {"type": "string"}
+        return {"type": "array", "items": items}
+    if isinstance(template, bool):
+        return {"type": ["boolean", "null"]}
+    if isinstance(template, (int, float)):
+        return {"type": ["number", "null"]}
+    return {"type": ["string", "null"]}
+
+
+def schema_key(schema: dict) -> str:
+    return hashlib.sha256(json.dumps(schema, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def get_validator(schema: dict):
+    """Return a precompiled validator for the schema (compiled once, then cached)."""
+    key = schema_key(schema)
+    validator = _VALIDATORS.get(key)
+    if validator is None:
+        validator = fastjsonschema.compile(schema)
+        _VALIDATORS[key] = validator
+    return validator
+
+
+def is_valid(schema: dict, data: Any) -> bool:
+    try:
+        get_validator(schema)(data)
+        return True
+    except fastjsonschema.JsonSchemaException:
+        return False
+
+
+def find_invalid_fields(schema: dict, data: Any, path: Tuple[str, ...] = ()) -> List[Tuple[str, ...]]:
+    """
+    Walk the schema and return the paths of fields that are missing or have the wrong type.
+    Only called after the compiled validator has rejected the output, so the fast path stays cheap.
+    """
+    if schema.get("type") == "object":
+        if not isinstance(data, dict):
+            return [path]
+        invalid = []
+        for key, sub_schema in schema.get("properties", {}).items():
+            if key not in data:
+                invalid.append(path + (key,))
+            else:
+                invalid.extend(find_invalid_fields(sub_schema, data[key], path + (key,)))
+        return invalid
+    if not is_valid(schema, data):
+        return [path]
+    return []
+
+
+def get_sub_schema(schema: dict, path: Tuple[str, ...]) -> dict:
+    for key in path:
+        schema = schema["properties"][key]
+    return schema
+
+
+def set_field(data: dict, path: Tuple[str, ...], value: Any) -> dict:
+    """Set a nested field in place, creating intermediate objects when they are missing."""
+    node = data
+    for key in path[:-1]:
+        if not isinstance(node.get(key), dict):
+            node[key] = {}
+        node = node[key]
+    node[path[-1]] = value
+    return data
+
+
+def strip_extra_fields(schema: dict, data: Any) -> Any:
+    """Drop keys the template does not define (the schema forbids additional properties)."""
+    if schema.get("type") == "object" and isinstance(data, dict):
+        props = schema.get("properties", {})
+        return {k: strip_extra_fields(props[k], v) for k, v in data.items() if k in props}
+    return copy.deepcopy(data)
+
+
+def empty_value(schema: dict) -> Any:
+    """The template's "not stated" value for a field: {} / [] / null, built so it always validates."""
+    types = schema.get("type")
+    if types == "object":
+        return {key: empty_value(sub) for key, sub in schema.get("properties", {}).items()}
+    if types == "array":
+        return []
+    if isinstance(types, list) and "null" in types:
+        return None
+    return {"string": "", "number": 0, "integer": 0, "boolean": False}.get(types)
+
+
+def field_repair_schema(sub_schema: dict) -> dict:
+    """Wrap a field schema so the repair prompt always returns a JSON object."""
+    return {
+        "type": "object",
+        "properties": {"value": sub_schema},
+        "required": ["value"],
+        "additionalProperties": False,
+    }
@@ -0,0 +1,275 @@
+# services/scheduler.py
+import os
+import time
+import asyncio
+import threading
+from collections import deque
+from contextlib import contextmanager, asynccontextmanager
+
+# Lower value = served first
+PRIORITIES = {"live": 0, "interactive": 1, "batch": 2}
+DEFAULT_PRIORITY = "interactive"
+
+STT_SLOTS = int(os.environ.get("SCHED_STT_SLOTS", os.environ.get("STT_EXPECTED_CONCURRENCY", "1")))
+LLM_SLOTS = int(os.environ.get("SCHED_LLM_SLOTS", "2"))
+# Max waiting requests per priority class before new ones are rejected with 429.
+# Request paths wait asynchronously (no thread held), so these do not compete with the worker thread pool.
+MAX_QUEUE = {
+    "live": int(os.environ.get("SCHED_MAX_QUEUE_LIVE", "32")),
+    "interactive": int(os.environ.get("SCHED_MAX_QUEUE_INTERACTIVE", "32")),
+    "batch": int(os.environ.get("SCHED_MAX_QUEUE_BATCH", "256")),
+}
+URGENT_WINDOW_S = float(os.environ.get("SCHED_URGENT_WINDOW_S", "5"))  # deadlines this close jump the fair-share order
+
+
+class SchedulerSaturated(Exception):
+    def __init__(self, stage: str, priority: str, retry_after: float):
+        super().__init__(f"{stage} queue for '{priority}' requests is full, retry in {retry_after:.0f}s")
+        self.stage = stage
+        self.priority = priority
+        self.retry_after = retry_after
+
+
+class Ticket:
+    def __init__(self, tenant: str, priority: str, deadline: float = None, notify=None):
+        self.tenant = tenant
+        self.priority = priority
+        self.deadline = deadline        # absolute time.monotonic() or None
+        self.enqueued = time.monotonic()
+        self.granted_at = None
+        self.notify = notify            # called (under the scheduler lock) when the slot is granted
+
+
+class StageScheduler:
+    def __init__(self, name: str, capacity: int, max_queue: dict = None, ewma_alpha: float = 0.2):
+        """
+        Gate one pipeline stage (STT or LLM) to `capacity` concurrent requests.
+        Ordering among waiting requests:
+        1. priority class (live > interactive > batch)
+        2. within a class, any request whose deadline is within URGENT_WINDOW_S goes first (earliest deadline)
+        3. otherwise weighted fair share: the tenant with the least service time used (virtual time) goes next,
+           taking its own earliest-deadline request
+        Admission is enforced when a request joins the queue: if it cannot start right away and its class
+        already has `max_queue` waiters, SchedulerSaturated is raised. Waiting is asynchronous in request
+        handlers (acquire_async / slot_async); acquire / slot block the calling thread and are meant for
+        background threads (draft timers).
+        """
+        self.name = name
+        self.capacity = max(1, capacity)
+        self.max_queue = dict(max_queue or MAX_QUEUE)
+        self.ewma_alpha = ewma_alpha
+
+        self._lock = threading.Lock()
+        self._waiting = {p: [] for p in PRIORITIES}
+        self._running = 0
+        self._running_by_tenant = {}
+        self._virtual_time = {}
+        self._weights = {}
+        self._service_ewma = None
+        self._waits = deque(maxlen=500)
+        self._counters = {p: {"admitted": 0, "rejected": 0, "completed": 0} for p in PRIORITIES}
+
+    def set_weight(self, tenant: str, weight: float):
+        """Share of service for `tenant` (default 1.0). Forgotten, like its virtual time, once the tenant is idle."""
+        with self._lock:
+            self._weights[tenant] = max(weight, 1e-6)
+
+    # ---------------- Admission ----------------
+    def _retry_after(self, priority: str) -> float:
+        # Caller holds the lock
+        ahead = sum(len(self._waiting[p]) for p in PRIORITIES if PRIORITIES[p] <= PRIORITIES[priority])
+        service = self._service_ewma or 5.0
+        return max(1.0, (ahead + 1) * service / self.capacity)
+
+    def _full(self, priority: str) -> bool:
+        # Caller holds the lock
+        return self._running >= self.capacity and len(self._waiting[priority]) >= self.max_queue[priority]
+
+    def check_admission(self, priority: str = DEFAULT_PRIORITY):
+        """
+        Cheap early rejection before a handler reads/decodes an upload. Reserves nothing: the cap
+        itself is enforced when the request joins the queue.
+        """
+        priority = priority if priority in PRIORITIES else DEFAULT_PRIORITY
+        with self._lock:
+            if self._full(priority):
+                self._counters[priority]["rejected"] += 1
+                raise SchedulerSaturated(self.name, priority, self._retry_after(priority))
+
+    def _enqueue(self, ticket: Ticket, enforce: bool):
+        """Join the queue atomically with the cap check; dispatches immediately if a slot is free."""
+        with self._lock:
+            if enforce and self._full(ticket.priority):
+                self._counters[ticket.priority]["rejected"] += 1
+                raise SchedulerSaturated(self.name, ticket.priority, self._retry_after(ticket.priority))
+            self._counters[ticket.priority]["admitted"] += 1
+            # A tenant returning from idle starts at the current minimum, so it can't bank credit
+            active = [self._virtual_time.get(t.tenant, 0.0) for q in self._waiting.values() for t in q]
+            floor = min(active) if active else 0.0
+            self._virtual_time[ticket.tenant] = max(self._virtual_time.get(ticket.tenant, 0.0), floor)
+            self._waiting[ticket.priority].append(ticket)
+            self._dispatch()
+
+    def _withdraw(self, ticket: Ticket) -> bool:
+        """Remove a waiter that gave up (e.g. client disconnected). Returns True if it already holds a slot."""
+        with self._lock:
+            if ticket.granted_at is None:
+                self._waiting[ticket.priority].remove(ticket)
+                self._forget_if_idle(ticket.tenant)
+                self._dispatch()
+                return False
+            return True
+
+    # ---------------- Ordering ----------------
+    def _pick(self) -> Ticket:
+        # Caller holds the lock
+        now = time.monotonic()
+        for priority in sorted(PRIORITIES, key=PRIORITIES.get):
+            queue = self._waiting[priority]
+            if not queue:
+                continue
+            urgent = [t for t in queue if t.deadline is not None and t.deadline - now <= URGENT_WINDOW_S]
+            if urgent:
+                return min(urgent, key=lambda t: t.deadline)
+            # Least virtual time first; on a tie, the tenant that has been waiting longest
+            oldest = {}
+            for t in queue:
+                oldest[t.tenant] = min(oldest.get(t.tenant, t.enqueued), t.enqueued)
+            tenant = min(oldest, key=lambda name: (self._virtual_time.get(name, 0.0), oldest[name]))
+            candidates = [t for t in queue if t.tenant == tenant]
+            return min(candidates, key=lambda t: (t.deadline if t.deadline is not None else float("inf"), t.enqueued))
+        return None
+
+    def _forget_if_idle(self, tenant: str):
+        # Caller holds the lock. Tenants come from request headers, so per-tenant state must not
+        # outlive their work; an idle tenant re-enters at the current virtual-time floor anyway.
+        if tenant in self._running_by_tenant or any(t.tenant == tenant for q in self._waiting.values() for t in q):
+            return
+        self._virtual_time.pop(tenant, None)
+        self._weights.pop(tenant, None)
+
+    def _dispatch(self):
+        # Caller holds the lock
+        while self._running < self.capacity:
+            ticket = self._pick()
+            if ticket is None:
+                return
+            self._waiting[ticket.priority].remove(ticket)
+            self._running += 1
+            self._running_by_tenant[ticket.tenant] = self._running_by_tenant.get(ticket.tenant, 0) + 1
+            ticket.granted_at = time.monotonic()
+            self._waits.append(ticket.granted_at - ticket.enqueued)
+            ticket.notify()
+
+    # ---------------- Acquire / release ----------------
+    @staticmethod
+    def _ticket(tenant: str, priority: str, deadline_s: float, notify) -> Ticket:
+        priority = priority if priority in PRIORITIES else DEFAULT_PRIORITY
+        deadline = time.monotonic() + deadline_s if deadline_s is not None else None
+        return Ticket(tenant, priority, deadline, notify)
+
+    def acquire(self, tenant: str, priority: str = DEFAULT_PRIORITY, deadline_s: float = None, enforce: bool = True) -> Ticket:
+        """Block the calling thread until a slot is granted. deadline_s is relative (seconds from now)."""
+        granted = threading.Event()
+        ticket = self._ticket(tenant, priority, deadline_s, granted.set)
+        self._enqueue(ticket, enforce)
+        granted.wait()
+        return ticket
+
+    async def acquire_async(self, tenant: str, priority: str = DEFAULT_PRIORITY, deadline_s: float = None, enforce: bool = True) -> Ticket:
+        """Wait for a slot without holding a thread. deadline_s is relative (seconds from now)."""
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def notify():
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(None))
+
+        ticket = self._ticket(tenant, priority, deadline_s, notify)
+        self._enqueue(ticket, enforce)
+        try:
+            await granted
+        except asyncio.CancelledError:
+            if self._withdraw(ticket):
+                self.release(ticket)
+            raise
+        return ticket
+
+    def release(self, ticket: Ticket):
+        duration = time.monotonic() - ticket.granted_at
+        with self._lock:
+            self._running -= 1
+            self._running_by_tenant[ticket.tenant] -= 1
+            if not self._running_by_tenant[ticket.tenant]:
+                del self._running_by_tenant[ticket.tenant]
+            weight = self._weights.get(ticket.tenant, 1.0)
+            self._virtual_time[ticket.tenant] = self._virtual_time.get(ticket.tenant, 0.0) + duration / weight
+            self._service_ewma = duration if self._service_ewma is None else (
+                self.ewma_alpha * duration + (1 - self.ewma_alpha) * self._service_ewma
+            )
+            self._counters[ticket.priority]["completed"] += 1
+            self._forget_if_idle(ticket.tenant)
+            self._dispatch()
+
+    @contextmanager
+    def slot(self, tenant: str, priority: str = DEFAULT_PRIORITY, deadline_s: float = None, enforce: bool = True):
+        ticket = self.acquire(tenant, priority, deadline_s, enforce)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    @asynccontextmanager
+    async def slot_async(self, tenant: str, priority: str = DEFAULT_PRIORITY, deadline_s: float = None, enforce: bool = True):
+        ticket = await self.acquire_async(tenant, priority, deadline_s, enforce)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    # ---------------- Metrics ----------------
+    def metrics(self) -> dict:
+        with self._lock:
+            waits = sorted(self._waits)
+            tenants = {t.tenant for q in self._waiting.values() for t in q} | set(self._running_by_tenant)
+            return {
+                "capacity": self.capacity,
+                "running": self._running,
+                "queued": {p: len(q) for p, q in self._waiting.items()},
+                "counters": {p: dict(c) for p, c in self._counters.items()},
+                "service_time_ewma_s": self._service_ewma,
+                "wait_mean_s": sum(waits) / len(waits) if waits else 0.0,
+                "wait_p95_s": waits[int(0.95 * (len(waits) - 1))] if waits else 0.0,
+                "tenants": {
+                    tenant: {
+                        "queued": sum(1 for q in self._waiting.values() for t in q if t.tenant == tenant),
+                        "running": self._running_by_tenant.get(tenant, 0),
+                        "virtual_time_s": self._virtual_time.get(tenant, 0.0),
+                    }
+                    for tenant in sorted(tenants)
+                },
+            }
+
+
+class Scheduler:
+    def __init__(self, stt_slots: int = STT_SLOTS, llm_slots: int = LLM_SLOTS):
+        self.stages = {
+            "stt": StageScheduler("stt", stt_slots),
+            "llm": StageScheduler("llm", llm_slots),
+        }
+
+    def check_admission(self, stage: str, priority: str = DEFAULT_PRIORITY):
+        self.stages[stage].check_admission(priority)
+
+    def slot(self, stage: str, tenant: str = "default", priority: str = DEFAULT_PRIORITY,
+             deadline_s: float = None, enforce: bool = True):
+        return self.stages[stage].slot(tenant, priority, deadline_s, enforce)
+
+    def slot_async(self, stage: str, tenant: str = "default", priority: str = DEFAULT_PRIORITY,
+                   deadline_s: float = None, enforce: bool = True):
+        return self.stages[stage].slot_async(tenant, priority, deadline_s, enforce)
+
+    def metrics(self) -> dict:
+        return {name: stage.metrics() for name, stage in self.stages.items()}
+
+
+SCHEDULER = Scheduler()
@@ -0,0 +1,124 @@
+# services/stt_calibration.py
+import os
+import time
+import argparse
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from app.services.model_manager import DECODE_OPTIONS
+from app.services.stt_engines import CACHE_DIR, SAMPLE_RATE, host_key, _calibration_audio
+from app.utils.storage import read_json, write_json
+
+PROFILE_PATH = Path(os.environ.get("STT_PROFILE_PATH", str(Path(CACHE_DIR) / "stt_profiles.json")))
+COMPUTE_TYPES = ["int8", "int8_float32", "float32"]
+EXPECTED_CONCURRENCY = int(os.environ.get("STT_EXPECTED_CONCURRENCY", "1"))
+
+
+def thread_splits(cores: int, concurrency: int) -> list:
+    """
+    (cpu_threads, num_workers) splits to try for a given concurrency.
+    num_workers is how many transcriptions CTranslate2 runs in parallel; cpu_threads is per worker.
+    """
+    workers = sorted({w for w in (1, 2, 4, concurrency) if w <= concurrency})
+    splits = []
+    for w in workers:
+        per_worker = max(1, cores // w)
+        for threads in sorted({per_worker, max(1, per_worker // 2)}):
+            splits.append((threads, w))
+    return splits
+
+
+def benchmark(model_name: str, compute_type: str, cpu_threads: int, num_workers: int, audio, concurrency: int, model_dir: str = CACHE_DIR) -> float:
+    """
+    Aggregate real-time factor (wall time / total audio) with `concurrency` simultaneous streams,
+    decoded with the production settings (DECODE_OPTIONS) so the chosen profile fits the real workload.
+    """
+    from faster_whisper import WhisperModel
+
+    model = WhisperModel(
+        model_name, device="cpu", compute_type=compute_type,
+        cpu_threads=cpu_threads, num_workers=num_workers, download_root=model_dir,
+    )
+
+    def run(clip):
+        segments, _ = model.transcribe(clip, **DECODE_OPTIONS)
+        return " ".join(seg.text for seg in segments)
+
+    run(audio[:SAMPLE_RATE])  # warm-up
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as ex:
+        list(ex.map(run, [audio] * concurrency))
+    elapsed = time.perf_counter() - start
+    del model
+    return elapsed / (concurrency * len(audio) / SAMPLE_RATE)
+
+
+def calibrate(
+    models: list,
+    concurrencies: list = (1,),
+    compute_types: list = COMPUTE_TYPES,
+    audio=None,
+    profile_path: str | Path = PROFILE_PATH,
+) -> dict:
+    """
+    Benchmark compute types and thread/worker splits per model and concurrency, then save the best.
+    `audio` should be real consultation speech (defaults to the STT calibration clip).
+    """
+    audio = _calibration_audio() if audio is None else audio
+    cores = os.cpu_count() or 1
+    profiles = read_json(Path(profile_path), default={}) or {}
+    host = profiles.setdefault(host_key(), {})
+
+    for model_name in models:
+        for concurrency in concurrencies:
+            best = None
+            for compute_type in compute_types:
+                for cpu_threads, num_workers in thread_splits(cores, concurrency):
+                    try:
+                        rtf = benchmark(model_name, compute_type, cpu_threads, num_workers, audio, concurrency)
+                    except Exception as e:
+                        print(f"[STTCalibration] {model_name} {compute_type} unsupported: {e}")
+                        break
+                    print(
+                        f"[STTCalibration] {model_name} x{concurrency}: {compute_type} "
+                        f"threads={cpu_threads} workers={num_workers} -> RTF {rtf:.3f}"
+                    )
+                    if best is None or rtf < best["rtf"]:
+                        best = {
+                            "compute_type": compute_type,
+                            "cpu_threads": cpu_threads,
+                            "num_workers": num_workers,
+                            "rtf": rtf,
+                        }
+            if best:
+                best["measured_at"] = time.time()
+                host.setdefault(model_name, {})[str(concurrency)] = best
+                print(f"[STTCalibration] Best for {model_name} x{concurrency}: {best}")
+
+    write_json(Path(profile_path), profiles)
+    return host
+
+
+def load_profile(model_name: str, concurrency: int = EXPECTED_CONCURRENCY, profile_path: str | Path = PROFILE_PATH) -> dict:
+    """
+    Calibrated settings for this host and model: the profile measured at the largest concurrency
+    not above `concurrency` (or the smallest one measured). None if the model was never calibrated.
+    """
+    profiles = read_json(Path(profile_path), default={}) or {}
+    by_concurrency = profiles.get(host_key(), {}).get(model_name)
+    if not by_concurrency:
+        return None
+    levels = sorted(int(c) for c in by_concurrency)
+    eligible = [c for c in levels if c <= concurrency]
+    return by_concurrency[str(eligible[-1] if eligible else levels[0])]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Calibrate faster-whisper compute type and CPU threads for this host")
+    parser.add_argument("--models", nargs="+", default=["tiny.en", "small.en"], help="Models to calibrate")
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 4], help="Expected concurrent streams")
+    parser.add_argument("--compute-types", nargs="+", default=COMPUTE_TYPES, help="Compute types to try")
+    parser.add_argument("--audio", default=None, help="Speech sample (mono 16kHz WAV); defaults to STT_CALIBRATION_AUDIO")
+    args = parser.parse_args()
+
+    calibrate(args.models, args.concurrency, args.compute_types, _calibration_audio(args.audio))
+    print(f"[STTCalibration] Profiles saved to: {PROFILE_PATH}")
@@ -0,0 +1,376 @@
+# services/stt_engines.py
+import os
+import time
+import platform
+import tempfile
+import threading
+from pathlib import Path
+import numpy as np
+from app.services.model_manager import WhisperModelManager, NeMoModelManager
+from app.utils.storage import read_json, write_json
+
+SAMPLE_RATE = 16000
+CACHE_DIR = os.environ.get("STT_CACHE_DIR", "CACHE_DIR")
+SELECTION_CACHE = Path(CACHE_DIR) / "stt_selection.json"
+TARGET_RTF = float(os.environ.get("STT_TARGET_RTF", "0.3"))   # processing time / audio time we accept
+STREAM_COMMIT_S = 5.0                                          # seconds of audio per streamed segment
+# Real speech used to measure engines; a synthetic signal leaves the decoder almost idle and understates RTF
+CALIBRATION_AUDIO = os.environ.get(
+    "STT_CALIBRATION_AUDIO", str(Path(__file__).resolve().parents[1] / "data" / "calibration_speech.wav")
+)
+
+
+def _device() -> str:
+    try:
+        import torch
+        return "cuda" if torch.cuda.is_available() else "cpu"
+    except ImportError:
+        return "cpu"
+
+
+def _duration(audio) -> float:
+    if isinstance(audio, str):
+        import soundfile as sf
+        return sf.info(audio).duration
+    return len(audio) / SAMPLE_RATE
+
+
+class STTEngine:
+    """
+    Common interface for speech-to-text backends.
+    `audio` is either a file path or a float32 mono 16kHz numpy array.
+    """
+    name = "base"
+    has_timestamps = False   # True if transcribe_segments returns real per-segment timestamps
+
+    def __init__(self, model_name: str = None, model_dir: str = CACHE_DIR):
+        self.model_name = model_name
+        self.model_dir = model_dir
+        self.loaded = False
+
+    def load(self):
+        raise NotImplementedError
+
+    def transcribe(self, audio) -> str:
+        raise NotImplementedError
+
+    def transcribe_segments(self, audio) -> list:
+        """Timestamped segments; engines without timestamps return a single segment."""
+        return [{"start": 0.0, "end": _duration(audio), "text": self.transcribe(audio)}]
+
+    def batched_transcribe(self, audio, batch_size: int = 16) -> str:
+        return self.transcribe(audio)
+
+    def stream(self, chunks, commit_s: float = STREAM_COMMIT_S):
+        """
+        Transcribe an iterable of float32 16kHz chunks, yielding text each time `commit_s`
+        seconds of audio have been buffered (and once more for the remainder).
+        """
+        buffer = []
+        buffered = 0
+        for chunk in chunks:
+            chunk = np.asarray(chunk, dtype=np.float32)
+            buffer.append(chunk)
+            buffered += len(chunk)
+            if buffered >= commit_s * SAMPLE_RATE:
+                yield self.transcribe(np.concatenate(buffer)).strip()
+                buffer, buffered = [], 0
+        if buffered:
+            yield self.transcribe(np.concatenate(buffer)).strip()
+
+
+class FasterWhisperEngine(STTEngine):
+    name = "faster-whisper"
+    has_timestamps = True
+
+    def __init__(self, model_name: str = None, model_dir: str = CACHE_DIR, expected_concurrency: int = None):
+        super().__init__(model_name, model_dir)
+        self.expected_concurrency = expected_concurrency
+
+    def load(self):
+        if not self.loaded:
+            self.manager = WhisperModelManager(self.model_dir, use_faster=True)
+            # Batched pipeline wraps the base model, so both modes share one copy in memory.
+            # On CPU the calibrated profile for the expected concurrency is applied at load time.
+            self.manager.load_model(
+                self.model_name, batched_model=True, expected_concurrency=self.expected_concurrency
+            )
+            self.loaded = True
+        return self
+
+    def transcribe(self, audio) -> str:
+        return self.manager.transcribe(audio)
+
+    def transcribe_segments(self, audio) -> list:
+        return self.manager.transcribe_segments(audio)
+
+    def batched_transcribe(self, audio, batch_size: int = 16) -> str:
+        return self.manager.batched_transcribe(audio, batched_size=batch_size)
+
+
+class OpenAIWhisperEngine(STTEngine):
+    name = "openai-whisper"
+    has_timestamps = True
+
+    def load(self):
+        if not self.loaded:
+            self.manager = WhisperModelManager(self.model_dir, use_faster=False)
+            self.manager.load_model(self.model_name)
+            self.loaded = True
+        return self
+
+    def transcribe(self, audio) -> str:
+        return self.manager.transcribe(audio)
+
+    def transcribe_segments(self, audio) -> list:
+        return self.manager.transcribe_segments(audio)
+
+
+class NeMoEngine(STTEngine):
+    """model_name: "parakeet" (default) or "canary"."""
+    name = "nemo"
+
+    def load(self):
+        if not self.loaded:
+            self.model_name = self.model_name or "parakeet"
+            self.manager = NeMoModelManager(self.model_dir)
+            if self.model_name == "canary":
+                self.model = self.manager.load_canary()
+            else:
+                self.model = self.manager.load_parakeet()
+            self.loaded = True
+        return self
+
+    def _as_path(self, audio):
+        if isinstance(audio, str):
+            return audio, False
+        import soundfile as sf
+        tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".wav")
+        tmp.close()
+        sf.write(tmp.name, audio, SAMPLE_RATE)
+        return tmp.name, True
+
+    def _transcribe_paths(self, paths: list, batch_size: int = 1) -> list:
+        if self.model_name == "canary":
+            prompts = [
+                [{"role": "user", "content": f"Transcribe the following: {self.model.audio_locator_tag}", "audio": [p]}]
+                for p in paths
+            ]
+            answer_ids = self.model.generate(prompts=prompts, max_new_tokens=448)
+            return [self.model.tokenizer.ids_to_text(ids.cpu()) for ids in answer_ids]
+        hypotheses = self.model.transcribe(paths, batch_size=batch_size)
+        return [getattr(h, "text", h) for h in hypotheses]
+
+    def transcribe(self, audio) -> str:
+        return self.batched_transcribe(audio, batch_size=1)
+
+    def batched_transcribe(self, audio, batch_size: int = 16) -> str:
+        path, is_tmp = self._as_path(audio)
+        try:
+            return " ".join(self._transcribe_paths([path], batch_size=batch_size))
+        finally:
+            if is_tmp:
+                os.unlink(path)
+
+
+class MockEngine(STTEngine):
+    """CPU-only stand-in for tests: sleeps `rtf` seconds per second of audio and returns fixed text."""
+    name = "mock"
+
+    def __init__(self, model_name: str = None, model_dir: str = CACHE_DIR, rtf: float = 0.01, text: str = "mock transcription"):
+        super().__init__(model_name or "mock", model_dir)
+        self.rtf = rtf
+        self.text = text
+
+    def load(self):
+        self.loaded = True
+        return self
+
+    def transcribe(self, audio) -> str:
+        time.sleep(_duration(audio) * self.rtf)
+        return self.text
+
+
+ENGINES = {
+    "faster-whisper": FasterWhisperEngine,
+    "openai-whisper": OpenAIWhisperEngine,
+    "nemo": NeMoEngine,
+    "mock": MockEngine,
+}
+
+
+def supports_timestamps(engine: str) -> bool:
+    """Whether segments from this engine can be aligned to speakers (diarization needs timestamps)."""
+    return engine in ENGINES and ENGINES[engine].has_timestamps
+
+
+def create_engine(engine: str, model_name: str = None, **kwargs) -> STTEngine:
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown STT engine '{engine}'. Options: {', '.join(ENGINES)}")
+    return ENGINES[engine](model_name, **kwargs)
+
+
+# ---------------- Auto-selection ----------------
+def default_candidates(device: str = None) -> list:
+    """(engine, model) pairs, most accurate first."""
+    device = device or _device()
+    if device == "cuda":
+        return [("nemo", "parakeet"), ("faster-whisper", "large-v3"), ("faster-whisper", "medium.en"), ("faster-whisper", "small.en")]
+    return [("faster-whisper", "small.en"), ("faster-whisper", "base.en"), ("faster-whisper", "tiny.en")]
+
+
+def host_key() -> str:
+    return f"{platform.node()}|{os.cpu_count()}|{_device()}"
+
+
+def _calibration_audio(path: str | Path = None) -> np.ndarray:
+    """
+    Mono 16kHz speech clip used for RTF measurements (STT_CALIBRATION_AUDIO, or
+    app/data/calibration_speech.wav). Use a representative consultation excerpt of 15-60s.
+    """
+    path = Path(path or CALIBRATION_AUDIO)
+    if not path.exists():
+        raise FileNotFoundError(
+            f"No calibration speech at {path}. Set STT_CALIBRATION_AUDIO to a mono 16kHz WAV of real speech."
+        )
+    import soundfile as sf
+    audio, sample_rate = sf.read(str(path), dtype="float32")
+    if audio.ndim > 1:
+        audio = audio.mean(axis=1)
+    if sample_rate != SAMPLE_RATE:
+        raise ValueError(f"Calibration audio must be {SAMPLE_RATE} Hz, got {sample_rate} Hz.")
+    return audio
+
+
+def _synthetic_audio(seconds: float = 15.0) -> np.ndarray:
+    """Noise only; for mock engines, whose timing does not depend on the content."""
+    rng = np.random.default_rng(0)
+    return (0.01 * rng.standard_normal(int(seconds * SAMPLE_RATE))).astype(np.float32)
+
+
+def measure_rtf(engine: STTEngine, audio: np.ndarray) -> float:
+    """Real-time factor of one transcription after a warm-up pass (lower is faster)."""
+    engine.load()
+    engine.transcribe(audio[:SAMPLE_RATE])
+    start = time.perf_counter()
+    engine.transcribe(audio)
+    return (time.perf_counter() - start) / _duration(audio)
+
+
+_SELECTION_LOCK = threading.Lock()
+
+
+def select_engine(
+    candidates: list = None,
+    target_rtf: float = TARGET_RTF,
+    audio: np.ndarray = None,
+    cache_path: str | Path = SELECTION_CACHE,
+    refresh: bool = False,
+    **engine_kwargs,
+) -> dict:
+    """
+    Pick the most accurate (engine, model) whose measured real-time factor on this host is within
+    `target_rtf` (or the fastest one if none is). The choice is cached per host.
+    Measuring loads every candidate model: call it from a worker thread, never the event loop.
+    """
+    candidates = [tuple(c) for c in (candidates or default_candidates())]
+    with _SELECTION_LOCK:
+        # Concurrent first "auto" requests share one measurement instead of each benchmarking
+        cache = read_json(Path(cache_path), default={}) or {}
+        key = host_key()
+        cached = cache.get(key)
+        if cached and not refresh and [tuple(c) for c in cached.get("candidates", [])] == candidates:
+            return cached
+        return _measure_and_select(candidates, target_rtf, audio, cache, key, cache_path, **engine_kwargs)
+
+
+def _measure_and_select(candidates, target_rtf, audio, cache, key, cache_path, **engine_kwargs) -> dict:
+
+    audio = _calibration_audio() if audio is None else audio
+    measured = []
+    choice = None
+    for engine_name, model_name in candidates:
+        try:
+            rtf = measure_rtf(create_engine(engine_name, model_name, **engine_kwargs), audio)
+        except Exception as e:
+            print(f"[STTSelector] Skipping {engine_name}/{model_name}: {e}")
+            measured.append({"engine": engine_name, "model": model_name, "error": str(e)})
+            continue
+        print(f"[STTSelector] {engine_name}/{model_name}: RTF {rtf:.3f}")
+        measured.append({"engine": engine_name, "model": model_name, "rtf": rtf})
+        if rtf <= target_rtf:
+            choice = measured[-1]
+            break
+
+    if choice is None:
+        ok = [m for m in measured if "rtf" in m]
+        if not ok:
+            raise RuntimeError("No STT engine could be loaded on this host.")
+        choice = min(ok, key=lambda m: m["rtf"])
+
+    result = {
+        "engine": choice["engine"],
+        "model": choice["model"],
+        "rtf": choice["rtf"],
+        "target_rtf": target_rtf,
+        "candidates": [list(c) for c in candidates],
+        "measured": measured,
+        "measured_at": time.time(),
+    }
+    cache[key] = result
+    write_json(Path(cache_path), cache)
+    return result
+
+
+# ---------------- Registry ----------------
+_ENGINES = {}
+_ENGINES_LOCK = threading.Lock()       # guards the registry dicts only, never held while loading
+_LOAD_LOCKS = {}
+
+
+def get_engine(engine: str = "faster-whisper", model_name: str = None) -> STTEngine:
+    """
+    Return a loaded engine, reusing it across requests.
+    engine="auto" uses the cached host selection (measuring it on first use).
+    Loading/measuring blocks: call it from a worker thread, never the event loop.
+    """
+    if engine == "auto":
+        selection = select_engine()
+        engine, model_name = selection["engine"], selection["model"]
+    key = (engine, model_name)
+    with _ENGINES_LOCK:
+        instance = _ENGINES.get(key)
+        if instance is not None:
+            return instance
+        load_lock = _LOAD_LOCKS.setdefault(key, threading.Lock())
+    # Loading one model must not block requests for models that are already loaded
+    with load_lock:
+        with _ENGINES_LOCK:
+            instance = _ENGINES.get(key)
+        if instance is None:
+            instance = create_engine(engine, model_name).load()
+            with _ENGINES_LOCK:
+                _ENGINES[key] = instance
+    return instance
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Measure STT engines on this host and cache the choice")
+    parser.add_argument("--target-rtf", type=float, default=TARGET_RTF)
+    parser.add_argument("--mock", action="store_true", help="Use mock engines (no models needed)")
+    args = parser.parse_args()
+
+    if args.mock:
+        selection = select_engine(
+            candidates=[("mock", "slow"), ("mock", "fast")],
+            target_rtf=args.target_rtf,
+            audio=_synthetic_audio(),
+            cache_path=Path(tempfile.gettempdir()) / "stt_selection_mock.json",
+            refresh=True,
+            rtf=0.02,
+        )
+    else:
+        selection = select_engine(target_rtf=args.target_rtf, refresh=True)
+    print(f"[STTSelector] Selected {selection['engine']}/{selection['model']} (RTF {selection['rtf']:.3f})")
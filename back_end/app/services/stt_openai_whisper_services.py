@@ -1,21 +1,20 @@
 # stt_whisper_service.py
-import whisper
-from pydub import AudioSegment
-from faster_whisper import WhisperModel, BatchedInferencePipeline
-import os
+from app.services.file_utils import convert_to_mono_16khz
+from app.services.stt_engines import OpenAIWhisperEngine
 
 
 
 class WhisperSTT:
     def __init__(self, model_name: str = "tiny.en", device: str = "cpu"):
         """
-        Load Whisper model
+        Load Whisper model (openai-whisper, via the common STT engine interface)
         model_name: tiny/base/small/medium/large/turbo or their .en variants
-        device: "cpu" or "cuda"
+        device: kept for compatibility, the engine picks cuda when available
         """
-        self.model = whisper.load_model(model_name, device=device)
+        self.engine = OpenAIWhisperEngine(model_name).load()
+        self.model = self.engine.manager.models["whisper"]
 
-    def batched_transcribe(self, audio_path: str, language: str = None, task: str = "transcribe") -> str:
+    def transcribe(self, audio_path: str, language: str = None, task: str = "transcribe") -> str:
         """
         Transcribe audio file
         language: ISO or name (optional)
@@ -23,10 +22,13 @@ class WhisperSTT:
         """
         # Convert to mono 16kHz for safety
         mono_path = convert_to_mono_16khz(audio_path)
-        self.batched_model = BatchedInferencePipeline(self.model,)
         result = self.model.transcribe(mono_path, language=language, task=task)
         return result["text"]
 
+    def batched_transcribe(self, audio_path: str, language: str = None, task: str = "transcribe") -> str:
+        # openai-whisper has no batched pipeline; kept as an alias of transcribe()
+        return self.transcribe(audio_path, language=language, task=task)
+
 # Example usage
 if __name__ == "__main__":
     stt = WhisperSTT("tiny.en")  # smallest, fastest
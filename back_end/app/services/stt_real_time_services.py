@@ -20,7 +20,11 @@ DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 # ----------------------------
 # Setup
 # ----------------------------
-def real_time_stt(model_name=MODEL_NAME):
+def real_time_stt(model_name=MODEL_NAME, on_segment=None):
+    """
+    on_segment: optional callback receiving each completed phrase, e.g.
+    DraftNoteSession.add_segment to keep a draft note updated while recording.
+    """
     recognizer = sr.Recognizer()
     recognizer.energy_threshold = 300  # adjust if mic is too sensitive
     recognizer.dynamic_energy_threshold = False
@@ -84,6 +88,8 @@ def real_time_stt(model_name=MODEL_NAME):
                 text = " ".join([seg.text for seg in segments]).strip()
                 if phrase_complete:
                     transcription.append(text)
+                    if on_segment:
+                        on_segment(text)
                     phrase_bytes = b""  # reset after phrase complete
                 else:
                     transcription[-1] = text
@@ -2,7 +2,7 @@
 import argparse
 import json
 from pathlib import Path
-from llm_ollama_services import OllamaProcessor
+from app.services.llm_ollama_services import OllamaProcessor
 
 
 def run_llm_pipeline(
@@ -0,0 +1,237 @@
+import os
+import time
+import hashlib
+import threading
+from pathlib import Path
+import numpy as np
+import soundfile as sf
+from app.utils.storage import read_json, write_json
+
+ARCHIVE_DIR = Path(os.environ.get("AUDIO_ARCHIVE_DIR", "uploads"))
+ARCHIVE_FORMAT = os.environ.get("AUDIO_ARCHIVE_FORMAT", "flac")                   # flac (lossless) or opus
+MAX_ARCHIVE_BYTES = int(os.environ.get("AUDIO_ARCHIVE_MAX_BYTES", str(5 * 1024**3)))
+MAX_AGE_DAYS = float(os.environ.get("AUDIO_ARCHIVE_MAX_AGE_DAYS", "30"))           # 0 disables age-based eviction
+HOT_ACCESS_THRESHOLD = int(os.environ.get("AUDIO_ARCHIVE_HOT_ACCESSES", "2"))      # reads before a PCM cache is built
+MAX_PCM_CACHE_BYTES = int(os.environ.get("AUDIO_ARCHIVE_MAX_PCM_BYTES", str(1024**3)))
+INDEX_FLUSH_S = float(os.environ.get("AUDIO_ARCHIVE_INDEX_FLUSH_S", "30"))          # max delay before access stats hit disk
+
+# format -> (soundfile format, subtype, extension)
+FORMATS = {
+    "flac": ("FLAC", "PCM_16", ".flac"),
+    "opus": ("OGG", "OPUS", ".opus"),
+}
+
+
+class AudioArchive:
+    def __init__(
+        self,
+        root: str | Path = ARCHIVE_DIR,
+        fmt: str = ARCHIVE_FORMAT,
+        max_bytes: int = MAX_ARCHIVE_BYTES,
+        max_age_days: float = MAX_AGE_DAYS,
+        hot_threshold: int = HOT_ACCESS_THRESHOLD,
+        max_cache_bytes: int = MAX_PCM_CACHE_BYTES,
+        index_flush_s: float = INDEX_FLUSH_S,
+    ):
+        """
+        Content-addressed store for consultation audio.
+        - audio is kept compressed (FLAC/Opus) and keyed by the sha256 of its PCM samples
+        - retention: entries older than `max_age_days` are dropped, then least recently used
+          entries until the archive fits in `max_bytes`
+        - hot files get a raw int16 PCM cache that is memory-mapped, so time ranges can be
+          sliced without decoding the whole recording
+        - access stats from reads are persisted at most every `index_flush_s` seconds;
+          stores, deletes and evictions write the index immediately
+        """
+        if fmt not in FORMATS:
+            raise ValueError(f"Unsupported archive format '{fmt}'. Options: {', '.join(FORMATS)}")
+        self.root = Path(root)
+        self.audio_dir = self.root / "audio"
+        self.cache_dir = self.root / "pcm_cache"
+        self.audio_dir.mkdir(parents=True, exist_ok=True)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.root / "index.json"
+
+        self.fmt = fmt
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+        self.hot_threshold = hot_threshold
+        self.max_cache_bytes = max_cache_bytes
+        self.index_flush_s = index_flush_s
+
+        self._lock = threading.RLock()
+        self.index = read_json(self.index_path, default={}) or {}
+        self._dirty = False
+        self._last_flush = time.monotonic()
+
+    def _save_index(self):
+        write_json(self.index_path, self.index)
+        self._dirty = False
+        self._last_flush = time.monotonic()
+
+    def _touch_index(self):
+        """Mark access stats as changed; only rewrite the index once the flush interval has passed."""
+        self._dirty = True
+        if time.monotonic() - self._last_flush >= self.index_flush_s:
+            self._save_index()
+
+    def flush(self):
+        """Persist pending access stats (call on shutdown)."""
+        with self._lock:
+            if self._dirty:
+                self._save_index()
+
+    def _entry(self, key: str) -> dict:
+        entry = self.index.get(key)
+        if entry is None:
+            raise KeyError(f"Audio {key} not found in archive.")
+        return entry
+
+    # ---------------- Store ----------------
+    def store(self, wav_path: str | Path, name: str = None) -> str:
+        """Compress a (mono 16kHz) WAV into the archive and return its content hash key."""
+        audio, sample_rate = sf.read(str(wav_path), dtype="int16", always_2d=True)
+        audio = audio.mean(axis=1).astype(np.int16) if audio.shape[1] > 1 else audio[:, 0]
+        key = hashlib.sha256(audio.tobytes()).hexdigest()
+
+        with self._lock:
+            now = time.time()
+            if key in self.index:
+                # Same recording uploaded again: nothing new to store
+                self.index[key]["last_access"] = now
+                self._touch_index()
+                return key
+
+            sf_format, subtype, ext = FORMATS[self.fmt]
+            path = self.audio_dir / f"{key}{ext}"
+            sf.write(str(path), audio, sample_rate, format=sf_format, subtype=subtype)
+
+            self.index[key] = {
+                "file": path.name,
+                "name": name,
+                "format": self.fmt,
+                "sample_rate": sample_rate,
+                "frames": int(audio.shape[0]),
+                "duration": audio.shape[0] / sample_rate,
+                "bytes": path.stat().st_size,
+                "created": now,
+                "last_access": now,
+                "access_count": 0,
+            }
+            print(f"[AudioArchive] Stored {name or key} ({self.index[key]['bytes']} bytes, {self.fmt})")
+            # Never evict the recording being stored, even if it alone exceeds the byte budget
+            self.enforce_retention(keep=key)
+            self._save_index()
+        return key
+
+    # ---------------- Read ----------------
+    def read_range(self, key: str, start: float = 0.0, end: float = None) -> np.ndarray:
+        """Return float32 samples for [start, end) seconds without decoding the whole file."""
+        with self._lock:
+            entry = self._entry(key)
+            entry["last_access"] = time.time()
+            entry["access_count"] = entry.get("access_count", 0) + 1
+            self._touch_index()
+
+            sample_rate = entry["sample_rate"]
+            start_f = max(0, int(start * sample_rate))
+            end_f = entry["frames"] if end is None else min(entry["frames"], int(end * sample_rate))
+            if end_f <= start_f:
+                return np.zeros(0, dtype=np.float32)
+
+            pcm = self._open_pcm_cache(key, entry)
+            if pcm is None and entry["access_count"] >= self.hot_threshold:
+                pcm = self._build_pcm_cache(key, entry)
+
+        if pcm is not None:
+            return pcm[start_f:end_f].astype(np.float32) / 32768
+
+        with sf.SoundFile(str(self.audio_dir / entry["file"])) as f:
+            f.seek(start_f)
+            return f.read(end_f - start_f, dtype="float32")
+
+    def _pcm_path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.pcm"
+
+    def _open_pcm_cache(self, key: str, entry: dict):
+        path = self._pcm_path(key)
+        if not path.exists():
+            return None
+        return np.memmap(path, dtype=np.int16, mode="r", shape=(entry["frames"],))
+
+    def _build_pcm_cache(self, key: str, entry: dict):
+        """Decode once into a raw int16 file and memory-map it for later range reads."""
+        audio, _ = sf.read(str(self.audio_dir / entry["file"]), dtype="int16", always_2d=False)
+        path = self._pcm_path(key)
+        pcm = np.memmap(path, dtype=np.int16, mode="w+", shape=(entry["frames"],))
+        # Lossy codecs may decode a few samples short of the original length
+        n = min(len(audio), entry["frames"])
+        pcm[:n] = audio[:n]
+        pcm.flush()
+        del pcm
+        print(f"[AudioArchive] Built PCM cache for {key}")
+        self._enforce_cache_budget(keep=key)
+        return self._open_pcm_cache(key, entry)
+
+    # ---------------- Retention ----------------
+    def _remove(self, key: str):
+        entry = self.index.pop(key, None)
+        if entry is None:
+            return
+        for path in (self.audio_dir / entry["file"], self._pcm_path(key)):
+            if path.exists():
+                path.unlink()
+
+    def delete(self, key: str):
+        with self._lock:
+            self._entry(key)
+            self._remove(key)
+            self._save_index()
+
+    def enforce_retention(self, keep: str = None) -> list:
+        """
+        Evict expired entries, then least recently used ones until the archive fits the byte budget.
+        `keep` is never evicted by size (the recording just stored).
+        """
+        evicted = []
+        with self._lock:
+            if self.max_age_days > 0:
+                cutoff = time.time() - self.max_age_days * 86400
+                for key, entry in list(self.index.items()):
+                    if entry["created"] < cutoff:
+                        self._remove(key)
+                        evicted.append(key)
+
+            total = sum(e["bytes"] for e in self.index.values())
+            for key, entry in sorted(self.index.items(), key=lambda kv: kv[1]["last_access"]):
+                if total <= self.max_bytes:
+                    break
+                if key == keep:
+                    continue
+                total -= entry["bytes"]
+                self._remove(key)
+                evicted.append(key)
+
+            if evicted:
+                print(f"[AudioArchive] Evicted {len(evicted)} recording(s)")
+                self._save_index()
+        return evicted
+
+    def _enforce_cache_budget(self, keep: str = None):
+        caches = [p for p in self.cache_dir.glob("*.pcm")]
+        total = sum(p.stat().st_size for p in caches)
+        caches.sort(key=lambda p: self.index.get(p.stem, {}).get("last_access", 0))
+        for path in caches:
+            if total <= self.max_cache_bytes:
+                break
+            if path.stem == keep:
+                continue
+            total -= path.stat().st_size
+            path.unlink()
+
+    def list(self) -> list:
+        with self._lock:
+            return [
+                {"key": key, "cached": self._pcm_path(key).exists(), **entry}
+                for key, entry in sorted(self.index.items(), key=lambda kv: kv[1]["created"], reverse=True)
+            ]
@@ -0,0 +1,172 @@
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+from pathlib import Path
+from typing import Any
+from app.utils.storage import read_json, write_json
+
+JOBS_DIR = Path(os.environ.get("JOBS_DIR", Path(__file__).resolve().parents[2] / "jobs"))
+JOBS_MAX_AGE_DAYS = float(os.environ.get("JOBS_MAX_AGE_DAYS", "7"))  # transcripts/notes are patient data; 0 disables pruning
+
+
+def sha256_bytes(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def sha256_file(path: str | Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class JobStore:
+    def __init__(self, root: str | Path = JOBS_DIR):
+        """
+        Durable per-job checkpoints for the note pipeline.
+        Each job has a directory holding its inputs, stage outputs and a job.json recording which
+        stages completed. All writes are atomic, so a restarted worker can resume from the last
+        completed stage.
+        """
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def job_dir(self, job_id: str) -> Path:
+        return self.root / job_id
+
+    def _job_path(self, job_id: str) -> Path:
+        return self.job_dir(job_id) / "job.json"
+
+    def get(self, job_id: str) -> dict:
+        return read_json(self._job_path(job_id), default=None)
+
+    def create(self, job_id: str, params: dict) -> dict:
+        """
+        Create a job, or return the existing one (same id = same request, so this is idempotent).
+        Resubmitting an existing job refreshes its `updated` time so it is not pruned under a retry.
+        """
+        with self._lock:
+            job = self.get(job_id)
+            if job is not None:
+                job["updated"] = time.time()
+                write_json(self._job_path(job_id), job)
+                return job
+            now = time.time()
+            job = {
+                "id": job_id,
+                "status": "pending",
+                "params": params,
+                "stages": {},
+                "error": None,
+                "created": now,
+                "updated": now,
+            }
+            write_json(self._job_path(job_id), job)
+            return job
+
+    def _update(self, job_id: str, **fields) -> dict:
+        with self._lock:
+            job = self.get(job_id)
+            if job is None:
+                raise KeyError(f"Job {job_id} not found.")
+            job.update(fields)
+            job["updated"] = time.time()
+            write_json(self._job_path(job_id), job)
+            return job
+
+    def checkpoint(self, job_id: str, stage: str, **outputs) -> dict:
+        """Record a completed stage together with its (small) outputs."""
+        with self._lock:
+            job = self.get(job_id)
+            if job is None:
+                raise KeyError(f"Job {job_id} not found.")
+            job["stages"][stage] = {"completed_at": time.time(), **outputs}
+            job["status"] = "running"
+            job["updated"] = time.time()
+            write_json(self._job_path(job_id), job)
+            return job
+
+    def completed(self, job_id: str, stage: str) -> dict:
+        job = self.get(job_id) or {}
+        return job.get("stages", {}).get(stage)
+
+    def start(self, job_id: str) -> dict:
+        return self._update(job_id, status="running", error=None, attempts=(self.get(job_id) or {}).get("attempts", 0) + 1)
+
+    def fail(self, job_id: str, error: str) -> dict:
+        return self._update(job_id, status="failed", error=error)
+
+    def finish(self, job_id: str) -> dict:
+        return self._update(job_id, status="done", error=None)
+
+    def incomplete(self) -> list:
+        """Jobs interrupted mid-run (e.g. by a crash) that should be resumed."""
+        jobs = []
+        for path in self.root.glob("*/job.json"):
+            job = read_json(path, default=None)
+            if job and job.get("status") in ("pending", "running"):
+                jobs.append(job)
+        return sorted(jobs, key=lambda j: j["created"])
+
+    def prune(self, max_age_days: float = JOBS_MAX_AGE_DAYS, skip: set = ()) -> list:
+        """
+        Delete done and failed jobs (directory and all artifacts) not updated for `max_age_days`.
+        Pending/running jobs are kept so they can still be resumed. Returns the removed job ids.
+        """
+        if max_age_days <= 0:
+            return []
+        cutoff = time.time() - max_age_days * 86400
+        removed = []
+        for path in self.root.glob("*/job.json"):
+            with self._lock:
+                job = read_json(path, default=None)
+                if not job or job.get("status") not in ("done", "failed") or job["id"] in skip:
+                    continue
+                if job.get("updated", job.get("created", 0)) >= cutoff:
+                    continue
+                shutil.rmtree(path.parent, ignore_errors=True)
+            removed.append(job["id"])
+        return removed
+
+    # ---------------- Stage artifacts ----------------
+    def artifact_path(self, job_id: str, name: str) -> Path:
+        return self.job_dir(job_id) / name
+
+    def save_bytes(self, job_id: str, name: str, data: bytes) -> Path:
+        path = self.artifact_path(job_id, name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{name}.", suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        return path
+
+    def save_text(self, job_id: str, name: str, text: str) -> Path:
+        return self.save_bytes(job_id, name, text.encode("utf-8"))
+
+    def read_text(self, job_id: str, name: str) -> str:
+        return self.artifact_path(job_id, name).read_text(encoding="utf-8")
+
+    def save_json(self, job_id: str, name: str, data: Any) -> Path:
+        path = self.artifact_path(job_id, name)
+        write_json(path, data)
+        return path
+
+    def read_json(self, job_id: str, name: str, default: Any = None) -> Any:
+        return read_json(self.artifact_path(job_id, name), default=default)
+
+    def remove_artifacts(self, job_id: str, names: list):
+        """Drop large intermediates (e.g. audio) once the job no longer needs them."""
+        for name in names:
+            path = self.artifact_path(job_id, name)
+            if path.is_dir():
+                shutil.rmtree(path, ignore_errors=True)
+            elif path.exists():
+                path.unlink()
@@ -1,4 +1,6 @@
+import os
 import json
+import tempfile
 from pathlib import Path
 from typing import Any
 
@@ -15,8 +17,19 @@ def read_json(file_path: Path, default: Any = None):
         return default
 
 def write_json(file_path: Path, data: Any):
+    """Atomic write: a crash leaves either the old file or the new one, never a truncated mix."""
     file_path.parent.mkdir(parents=True, exist_ok=True)
-    file_path.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+    fd, tmp_path = tempfile.mkstemp(dir=file_path.parent, prefix=f".{file_path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(json.dumps(data, ensure_ascii=False, indent=2))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
 
 def list_notes() -> list[dict]:
     notes = []